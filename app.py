@@ -2,10 +2,8 @@
 import os
 
 from flask import Flask
-from peewee import SqliteDatabase
 
 APP_ROOT = os.path.dirname(os.path.realpath(__file__))
-DATABASE = os.path.join(APP_ROOT, './database/database.db')
 
 class CustomFlask(Flask):
   jinja_options = Flask.jinja_options.copy()
@@ -20,7 +18,6 @@ class CustomFlask(Flask):
 
 app = CustomFlask(__name__)
 app.config.from_object(__name__)
-db = SqliteDatabase(app.config['DATABASE'], pragmas=[('journal_mode', 'wal')])
 
 app.config['UPLOAD_FOLDER'] = './tempuploads'
 
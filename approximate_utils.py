@@ -0,0 +1,70 @@
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from utils import _snapshot_cached, _register_snapshot_preload
+from filter_utils import _filter_mask
+
+# Rows in the per snapshot sample, stratified by dataset so every dataset keeps at least one row
+SAMPLE_ROWS = 100000
+SAMPLE_STRATUM_COLUMN = "ATTRIBUTE_DatasetAccession"
+
+# Samples, keyed by snapshot version
+_redu_sample_cache = {}
+
+
+def _build_redu_sample(redu_df, snapshot_version):
+    strata, stratum_values = pd.factorize(redu_df[SAMPLE_STRATUM_COLUMN], use_na_sentinel=False)
+    stratum_sizes = np.bincount(strata)
+
+    fraction = min(1.0, SAMPLE_ROWS / max(len(redu_df), 1))
+    stratum_targets = np.maximum(1, np.round(stratum_sizes * fraction)).astype(np.int64)
+
+    # Same sample for the same snapshot in every web worker
+    seed = int(hashlib.sha1(snapshot_version.encode()).hexdigest()[:8], 16)
+    random_keys = np.random.default_rng(seed).random(len(redu_df))
+
+    # Taking the first rows of each stratum in random order
+    order = np.lexsort((random_keys, strata))
+    stratum_starts = np.concatenate([[0], np.cumsum(stratum_sizes)[:-1]])
+    positions = np.arange(len(order)) - stratum_starts[strata[order]]
+    sample_rows = np.sort(order[positions < stratum_targets[strata[order]]])
+
+    sample_df = redu_df.iloc[sample_rows]
+
+    return {
+        "df": sample_df,
+        "weights": (stratum_sizes / stratum_targets)[strata[sample_rows]],
+        "strata": strata[sample_rows],
+        "missing_strata": pd.isna(stratum_values),
+    }
+
+
+def _get_redu_sample(redu_df, snapshot_version):
+    return _snapshot_cached(_redu_sample_cache, snapshot_version, lambda: _build_redu_sample(redu_df, snapshot_version))
+
+
+def _matched_datasets(redu_sample, mask):
+    # Datasets with a matching row in the sample. Every dataset is in the sample but a dataset whose matching rows
+    # were all left out is missed, so this is a lower bound of the datasets matching on the full table.
+    sample_hits = np.bincount(redu_sample["strata"][mask], minlength=len(redu_sample["missing_strata"]))
+
+    return int(np.sum((sample_hits > 0) & ~redu_sample["missing_strata"]))
+
+
+def _approximate_counts(redu_sample, filter_query=None, row_ids=None):
+    # Estimated files and the lower bound of datasets under a filter, evaluated on the sample only
+    mask = _filter_mask(redu_sample["df"], filter_query)
+    if row_ids is not None:
+        mask &= redu_sample["df"].index.isin(row_ids)
+
+    approximate_counts = {
+        "files": int(round(redu_sample["weights"][mask].sum())),
+        SAMPLE_STRATUM_COLUMN: _matched_datasets(redu_sample, mask),
+    }
+
+    return approximate_counts, mask
+
+
+_register_snapshot_preload(_get_redu_sample)
@@ -0,0 +1,112 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+CHANGELOG_FOLDER = "changelog"
+
+
+def _row_key_column(old_df, new_df):
+    if "USI" in old_df.columns and "USI" in new_df.columns:
+        return "USI"
+
+    return "filename"
+
+
+def _row_hashes(df, columns):
+    # One 64 bit hash per row over the compared columns
+    return pd.util.hash_pandas_object(df[columns], index=False).to_numpy()
+
+
+def _snapshot_diff(old_df, new_df):
+    key_column = _row_key_column(old_df, new_df)
+    compared_columns = [column for column in new_df.columns if column in old_df.columns and column != key_column]
+
+    old_rows = pd.DataFrame({"key": old_df[key_column].astype(str).to_numpy(), "old_hash": _row_hashes(old_df, compared_columns), "old_row": np.arange(len(old_df))})
+    new_rows = pd.DataFrame({"key": new_df[key_column].astype(str).to_numpy(), "new_hash": _row_hashes(new_df, compared_columns), "new_row": np.arange(len(new_df))})
+
+    # Duplicated keys are compared on their first occurrence
+    old_rows = old_rows.drop_duplicates("key")
+    new_rows = new_rows.drop_duplicates("key")
+
+    merged_rows = old_rows.merge(new_rows, on="key", how="outer", indicator=True)
+
+    added_keys = merged_rows.loc[merged_rows["_merge"] == "right_only", "key"]
+    removed_keys = merged_rows.loc[merged_rows["_merge"] == "left_only", "key"]
+    changed_rows = merged_rows[(merged_rows["_merge"] == "both") & (merged_rows["old_hash"] != merged_rows["new_hash"])]
+
+    # Finding the changed attributes only for the rows whose hash changed, one column at a time
+    old_changed = old_df.iloc[changed_rows["old_row"].astype(np.int64).to_numpy()]
+    new_changed = new_df.iloc[changed_rows["new_row"].astype(np.int64).to_numpy()]
+
+    changed_columns = pd.Series("", index=np.arange(len(changed_rows)), dtype=object)
+    for column in compared_columns:
+        old_values = old_changed[column].to_numpy()
+        new_values = new_changed[column].to_numpy()
+        differs = ~((old_values == new_values) | (pd.isna(old_values) & pd.isna(new_values)))
+        changed_columns = changed_columns + np.where(differs, column + "|", "")
+
+    changes_df = pd.concat([
+        pd.DataFrame({"key": added_keys.to_numpy(), "change": "added", "changed_columns": ""}),
+        pd.DataFrame({"key": removed_keys.to_numpy(), "change": "removed", "changed_columns": ""}),
+        pd.DataFrame({"key": changed_rows["key"].to_numpy(), "change": "changed", "changed_columns": changed_columns.str.rstrip("|").to_numpy()}),
+    ], ignore_index=True)
+
+    summary = {
+        "key_column": key_column,
+        "added": len(added_keys),
+        "removed": len(removed_keys),
+        "changed": len(changed_rows),
+        "columns_added": [column for column in new_df.columns if column not in old_df.columns],
+        "columns_removed": [column for column in old_df.columns if column not in new_df.columns],
+    }
+
+    return changes_df, summary
+
+
+def _write_changelog(snapshots_path, version, previous_version, changes_df):
+    # Changelogs are kept after their snapshots are pruned, they are small compared to the metadata
+    changelog_path = os.path.join(snapshots_path, CHANGELOG_FOLDER)
+    os.makedirs(changelog_path, exist_ok=True)
+
+    changes_df = changes_df.assign(version=version, previous_version=previous_version)
+
+    # The previous version is also kept in the file metadata, so snapshots without changes still chain
+    changes_table = pa.Table.from_pandas(changes_df.reset_index(drop=True), preserve_index=False)
+    changes_table = changes_table.replace_schema_metadata({**(changes_table.schema.metadata or {}), b"previous_version": previous_version.encode()})
+
+    temporary_path = os.path.join(changelog_path, "." + version + ".feather")
+    feather.write_feather(changes_table, temporary_path)
+    os.replace(temporary_path, os.path.join(changelog_path, version + ".feather"))
+
+
+def _changes_since(snapshots_path, since_version, until_version):
+    # Concatenated changelogs of all versions after since_version, in the order they have to be applied
+    changes_columns = ["version", "previous_version", "key", "change", "changed_columns"]
+
+    # A client on the served version is up to date, even before the first changelog is written
+    if since_version == until_version:
+        return pd.DataFrame(columns=changes_columns)
+
+    changelog_path = os.path.join(snapshots_path, CHANGELOG_FOLDER)
+    if not os.path.exists(changelog_path):
+        return None
+
+    versions = sorted(filename[:-len(".feather")] for filename in os.listdir(changelog_path) \
+                      if filename.endswith(".feather") and not filename.startswith("."))
+    versions = [version for version in versions if since_version < version <= until_version]
+
+    if len(versions) == 0:
+        return None
+
+    changes_tables = [feather.read_table(os.path.join(changelog_path, version + ".feather")) for version in versions]
+
+    # The chain has to start at since_version, otherwise the client is too far behind and needs a full download
+    if changes_tables[0].schema.metadata[b"previous_version"].decode() != since_version:
+        return None
+
+    changes_df = pd.concat([changes_table.to_pandas() for changes_table in changes_tables], ignore_index=True)
+
+    return changes_df[changes_columns]
@@ -1 +1,6 @@
 PATH_TO_ORIGINAL_MAPPING_FILE =  "/app/workflows/PublicDataset_ReDU_Metadata_Workflow/nf_output/merged_metadata.tsv" #global ReDU metadata
+PATH_TO_MS2_INDEX = "/app/workflows/ms2_index" #local MS2 spectral similarity index, searched instead of FASST when present
+PATH_TO_RUN_HISTORY = "/app/logs/run_history.feather" #parsed nextflow traces of all metadata workflow runs
+PATH_TO_SNAPSHOTS = "/app/workflows/snapshots" #versioned ReDU metadata snapshots published by the worker, the web server serves the one in CURRENT
+PATH_TO_ONTOLOGY_CLOSURES = "/app/workflows/ontology_closures" #UBERON, DOID and NCBI taxonomy closure tables built by ontology_closure_utils.py, used by the is_a filter
+QUERY_BACKEND = "pandas" #"pandas" keeps table filters, sorts, term counts and downloads in memory, "duckdb" runs them over the snapshot Parquet file when duckdb is installed
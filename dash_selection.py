@@ -1,61 +1,29 @@
 import requests
 import os
 import dash
-from dash import dcc, html, dash_table, Input, Output, State, callback_context, Dash
+from dash import dcc, html, dash_table, Input, Output, State, callback_context, Dash, no_update
 import dash_bootstrap_components as dbc
 from dash.exceptions import PreventUpdate
-import pandas as pd
-import re
 import math
 import sys
 import json
 
 from app import app
 
-from utils import _load_redu_sampledata, _metadata_last_modified
-
-def _filter_redu_sampledata(redu_df, filter_query=None):
-
-    print(filter_query, file=sys.stderr, flush=True)
-
-    if filter_query:
-        filtering_expressions = filter_query.split(' && ')
-        for filter_part in filtering_expressions:
-            col_name, operator, value = split_filter_part(filter_part)
-            print('col_name, operator, value', file=sys.stderr, flush=True)
-            print(col_name, operator, value, file=sys.stderr, flush=True)
-            if operator and col_name in redu_df.columns:
-                # Apply operator logic as previously defined
-                if operator == 'contains':
-                    redu_df = redu_df[
-                        redu_df[col_name].astype(str).str.contains(value, case=False, na=False, regex=True)]
-                if operator == 'scontains':
-                    redu_df = redu_df[
-                        redu_df[col_name].astype(str).str.contains(value, case=True, na=False, regex=True)]
-                elif operator == '=' or operator == 's=':
-                    redu_df = redu_df[redu_df[col_name] == value]
-                elif operator == '!=' or operator == 's!=':
-                    redu_df = redu_df[redu_df[col_name] != value]
-                elif operator == '<' or operator == 's<':
-                    redu_df = redu_df[
-                        pd.to_numeric(redu_df[col_name], errors='coerce') < float(value)]
-                elif operator == '<=' or operator == 's<=':
-                    redu_df = redu_df[
-                        pd.to_numeric(redu_df[col_name], errors='coerce') <= float(value)]
-                elif operator == '>' or operator == 's>':
-                    redu_df = redu_df[
-                        pd.to_numeric(redu_df[col_name], errors='coerce') > float(value)]
-                elif operator == '>='  or operator == 's>=':
-                    redu_df = redu_df[
-                        pd.to_numeric(redu_df[col_name], errors='coerce') >= float(value)]
-
-    return redu_df
-
-    
+import tasks
+from utils import _load_redu_sampledata, _redu_snapshot, _snapshot_cached
+from fasst_utils import _fasst_search_key, _fasst_row_ids
+from serialization_utils import _records
+from filter_utils import _filter_redu_sampledata
+from approximate_utils import _get_redu_sample, _approximate_counts
+from duckdb_utils import _duckdb_query, _duckdb_table_page, _duckdb_filtered
 
 # Load the data
 df_redu = _load_redu_sampledata()
 
+# Summary card contents, keyed by snapshot version
+_summary_stats_cache = {}
+
 # Define column configurations
 default_columns = ["SampleType", "SampleTypeSub1", "NCBITaxonomy", "UBERONBodyPartName", "MassSpectrometer", "USI"]
 
@@ -218,6 +186,8 @@ panredu_layout = dbc.Container(fluid=True, children=[
                             html.H4(['Filter Table'], style={'font-weight': 'bold', 'text-decoration': 'underline', 'text-align': 'center', 'width': '100%', 'margin': '0 auto'}),
                             dbc.Button("Subset Table to mz(X)ML files", id="subset-mzml-button", color="info",
                                        className="mb-2", style={"width": "100%", "height": "23%", "text-align": "center"}),
+                            dbc.Button("Subset Table to files matching MS2 scan", id="subset-fasstmasst-button", color="info",
+                                       className="mb-2", style={"width": "100%", "height": "23%", "text-align": "center"}),
                             html.P(['Or use the column filters below,..'],
                                    className='text-center mb-4', style={'fontSize': '18px'})
                         ],
@@ -298,12 +268,24 @@ panredu_layout = dbc.Container(fluid=True, children=[
             dbc.Row([
                 html.Div(id='page-count', className='mt-2'),  # Page count div
                 html.Div(id='rows-remaining', className='mt-2'),  # Rows remaining div
+                dbc.Switch(id='approximate-switch', label="Approximate counts while filtering", value=False, className='mt-2'),
+                html.Div([
+                    html.Span(id='fasstmasst-status'),
+                    dbc.Button("Clear MS2 subset", id="clear-fasstmasst-button", color="link", size="sm"),
+                ], className='mt-2'),  # MS2 scan subset status div
                 html.Div(id='dummy-div', style={'display': 'none'})  # Any additional elements if needed
             ], justify="end", className="text-end"),
 
             # Additional Components if Needed
             dcc.Download(id="download-dataframe-csv"),            
 
+            # MS2 scan subset search state, polled while the worker runs the search
+            dcc.Store(id="fasstmasst-store", data=None),
+
+            # Table state shown with estimates, the exact results replace them when they are ready
+            dcc.Store(id="exact-table-store", data=None),
+            dcc.Interval(id="fasstmasst-interval", interval=3000, disabled=True),
+
             # Modal for settings popup
             dbc.Modal(
                 [
@@ -410,52 +392,23 @@ dash_app.layout = html.Div([
 
 
 
-# Helper function for parsing filtering expressions
-def split_filter_part(filter_part):
-
-    print(filter_part, file=sys.stderr, flush=True)
-    operators = [
-        's>=',
-        's<=',
-        's>',
-        's<',
-        's!=',
-        's=',
-        '>=',
-        '<=',
-        '>',
-        '<',
-        '!=',
-        '=',
-        'contains',
-        'scontains',
-        'datestartswith',
-    ]
-    for operator in operators:
-        regex = r'\{(?P<col_name>[^\}]+)\} ' + re.escape(operator) + r' "?(.+?)"?$'
-        filter_part = filter_part.strip()
-        match = re.match(regex, filter_part)
-        if match:
-            col_name = match.group('col_name')
-            value = match.group(2)
-            operator = operator.strip()
-
-            print(col_name, operator, value, file=sys.stderr, flush=True)
-            return col_name, operator, value
-    return None, None, None
-
-
-
 @dash_app.callback(
     Output("summary-stats", "children"),
     Input("data-table", "page_current")
 )
 def update_summary_stats(n_clicks):
-    
-    df_redu = _load_redu_sampledata()
+    # The stats only change with the snapshot, so they are computed once per snapshot
+    redu_snapshot = _redu_snapshot()
+
+    return _snapshot_cached(_summary_stats_cache, redu_snapshot["version"], lambda: _summary_stats_card(redu_snapshot))
+
+
+def _summary_stats_card(redu_snapshot):
 
+    df_redu = redu_snapshot["df"]
 
-    last_modified = _metadata_last_modified()
+
+    last_modified = redu_snapshot["last_modified"]
 
 
     last_modified = last_modified.strftime("%Y-%m-%d %H:%M %Z")
@@ -640,6 +593,105 @@ def populate_filters(n_clicks_mzml,
 
 
 
+@dash_app.callback(
+    Output("fasstmasst-modal", "is_open"),
+    Output("fasstmasst-store", "data"),
+    Output("fasstmasst-interval", "disabled"),
+    Output("fasstmasst-status", "children"),
+    Input("subset-fasstmasst-button", "n_clicks"),
+    Input("submit-fasstmasst", "n_clicks"),
+    Input("clear-fasstmasst-button", "n_clicks"),
+    Input("fasstmasst-interval", "n_intervals"),
+    State("usi", "value"),
+    State("min-cosine", "value"),
+    State("min-matching-peaks", "value"),
+    State("fragment-tolerance", "value"),
+    State("precursor-tolerance", "value"),
+    State("fasstmasst-store", "data"),
+    prevent_initial_call=True
+)
+def update_fasstmasst_search(open_clicks,
+                             submit_clicks,
+                             clear_clicks,
+                             n_intervals,
+                             usi,
+                             min_cosine,
+                             min_matching_peaks,
+                             fragment_tolerance,
+                             precursor_tolerance,
+                             fasstmasst_data):
+
+    ctx = callback_context
+    if not ctx.triggered:
+        raise PreventUpdate
+
+    triggered_id = ctx.triggered[0]['prop_id'].split('.')[0]
+
+    if triggered_id == 'subset-fasstmasst-button':
+        return True, dash.no_update, dash.no_update, dash.no_update
+
+    if triggered_id == 'clear-fasstmasst-button':
+        return False, None, True, ""
+
+    if triggered_id == 'submit-fasstmasst':
+        if not usi or None in [min_cosine, min_matching_peaks, fragment_tolerance, precursor_tolerance]:
+            return True, dash.no_update, dash.no_update, "Please fill in all MS2 search parameters"
+
+        search_key = _fasst_search_key(usi, min_cosine, min_matching_peaks, fragment_tolerance, precursor_tolerance)
+
+        # Reusing the stored or already queued search if this exact search was submitted before, otherwise queueing it on the worker
+        task_id = tasks.queue_fasst_search(usi, min_cosine, min_matching_peaks, fragment_tolerance, precursor_tolerance)
+
+        fasstmasst_data = {
+            "key": search_key,
+            "task_id": task_id,
+            "usi": usi,
+            "status": "PENDING"
+        }
+
+        return False, fasstmasst_data, False, "MS2 search running for {}".format(usi)
+
+    # Polling the worker for the running search
+    if not fasstmasst_data:
+        return dash.no_update, dash.no_update, True, dash.no_update
+
+    task_result = tasks.celery_instance.AsyncResult(fasstmasst_data["task_id"])
+
+    if task_result.state == "SUCCESS":
+        fasstmasst_data = dict(fasstmasst_data, status="SUCCESS")
+        status_text = "Subset to {} files matching MS2 scan {}".format(len(task_result.result["usis"]), fasstmasst_data["usi"])
+
+        return dash.no_update, fasstmasst_data, True, status_text
+
+    if task_result.state in ["FAILURE", "REVOKED"]:
+        return dash.no_update, None, True, "MS2 search failed for {}".format(fasstmasst_data["usi"])
+
+    raise PreventUpdate
+
+
+
+def _approximate_number(number):
+    # 1234567 -> 1.2M, estimates are not shown with more precision than they have
+    if number >= 1000000:
+        return f"{number / 1000000:.1f}M"
+    if number >= 1000:
+        return f"{number / 1000:.1f}k"
+
+    return str(number)
+
+
+def _fasstmasst_row_ids(redu_snapshot, fasstmasst_data):
+    # Row ids of the files matching the finished MS2 search, None if no search is applied
+    if not fasstmasst_data or fasstmasst_data.get("status") != "SUCCESS":
+        return None
+
+    def _load_file_usis():
+        return tasks.celery_instance.AsyncResult(fasstmasst_data["task_id"]).get(timeout=30)["usis"]
+
+    return _fasst_row_ids(redu_snapshot["df"], fasstmasst_data["key"], redu_snapshot["version"], _load_file_usis)
+
+
+
 @dash_app.callback(
     Output("data-table", "data"),
     Output("rows-remaining", "children"),
@@ -648,44 +700,123 @@ def populate_filters(n_clicks_mzml,
     Output("massql-button", "href"),
     Output("dashboard-button", "href"),
     Output("loading-output-232", "children"),
+    Output("exact-table-store", "data"),
     Input("data-table", "page_current"),
     Input("data-table", "page_size"),
     Input("data-table", "sort_by"),
     Input("data-table", "filter_query"),
     Input('data-table', 'selected_rows'),
     Input("network-link-button", "n_clicks"),
+    Input("fasstmasst-store", "data"),
+    Input("data-table", "hidden_columns"),
+    Input("approximate-switch", "value"),
     State("data-table", "columns")
 )
-def update_table_display(page_current, page_size, sort_by, filter_query, selected_rows, visible_columns, n_clicks):
+def update_table_display(page_current, page_size, sort_by, filter_query, selected_rows, n_clicks, fasstmasst_data, hidden_columns, approximate, table_columns):
 
     print('first filter state', file=sys.stderr, flush=True)
     print(filter_query, file=sys.stderr, flush=True)
 
-    df_redu = _load_redu_sampledata()
+    table_state = {
+        "page_current": page_current,
+        "page_size": page_size,
+        "sort_by": sort_by,
+        "filter_query": filter_query,
+        "selected_rows": selected_rows,
+        "fasstmasst_data": fasstmasst_data,
+        "hidden_columns": hidden_columns,
+        "table_columns": table_columns,
+    }
 
-    df_redu_filtered = _filter_redu_sampledata(df_redu, filter_query)
+    # Unfiltered tables are cheap, estimates are only shown while filtering
+    if approximate and filter_query:
+        return _table_display(approximate=True, **table_state) + (table_state,)
+
+    return _table_display(**table_state) + (no_update,)
 
-    # Sorting
-    if sort_by:
-        df_redu_filtered = df_redu_filtered.sort_values(
-            [col['column_id'] for col in sort_by],
-            ascending=[col['direction'] == 'asc' for col in sort_by],
-            inplace=False
-        )
+
+@dash_app.callback(
+    Output("data-table", "data", allow_duplicate=True),
+    Output("rows-remaining", "children", allow_duplicate=True),
+    Output("page-count", "children", allow_duplicate=True),
+    Output("mn-button", "href", allow_duplicate=True),
+    Output("massql-button", "href", allow_duplicate=True),
+    Output("dashboard-button", "href", allow_duplicate=True),
+    Output("loading-output-232", "children", allow_duplicate=True),
+    Input("exact-table-store", "data"),
+    prevent_initial_call=True
+)
+def update_exact_table_display(table_state):
+    # Runs after the estimates went out, then replaces them with the exact results
+    if not table_state:
+        raise PreventUpdate
+
+    return _table_display(**table_state)
+
+
+def _table_display(page_current, page_size, sort_by, filter_query, selected_rows, fasstmasst_data, hidden_columns, table_columns, approximate=False):
+    redu_snapshot = _redu_snapshot()
+    df_redu = redu_snapshot["df"]
+
+    # Intersecting with the files matching the MS2 scan search
+    fasstmasst_row_ids = _fasstmasst_row_ids(redu_snapshot, fasstmasst_data)
+
+    # Only sending the visible columns, hidden ones are fetched when they are unhidden since that triggers this callback
+    table_column_ids = [column["id"] for column in table_columns] if table_columns else all_columns_ordered
+    hidden_columns = set(hidden_columns or [])
+    visible_columns = [column for column in table_column_ids if column not in hidden_columns]
+
+    # USI is always needed to build the links for selected rows
+    if "USI" not in visible_columns:
+        visible_columns.append("USI")
+
+    # Filtering, sorting and paging in DuckDB, only the page comes back
+    duckdb_page = None
+    if not approximate:
+        duckdb_page = _duckdb_query(redu_snapshot, _duckdb_table_page, filter_query, sort_by, page_current, page_size, visible_columns, fasstmasst_row_ids)
+
+    if approximate:
+        # Filtering the per snapshot sample only, its rows stand in for the table until the exact results arrive
+        redu_sample = _get_redu_sample(df_redu, redu_snapshot["version"])
+        approximate_counts, sample_mask = _approximate_counts(redu_sample, filter_query, fasstmasst_row_ids)
+        df_redu_filtered = redu_sample["df"][sample_mask]
+    elif duckdb_page is None:
+        df_redu_filtered = _filter_redu_sampledata(df_redu, filter_query)
+
+        if fasstmasst_row_ids is not None:
+            df_redu_filtered = df_redu_filtered[df_redu_filtered.index.isin(fasstmasst_row_ids)]
+
+    if duckdb_page is None:
+        # Sorting
+        if sort_by:
+            df_redu_filtered = df_redu_filtered.sort_values(
+                [col['column_id'] for col in sort_by],
+                ascending=[col['direction'] == 'asc' for col in sort_by],
+                inplace=False
+            )
+
+        total_filtered_rows = len(df_redu_filtered)
+
+        # Slice data based on current page
+        start_idx = page_current * page_size
+        end_idx = start_idx + page_size
+        paginated_data = df_redu_filtered.iloc[start_idx:end_idx]
+    else:
+        total_filtered_rows, paginated_data = duckdb_page
 
     # Pagination
-    total_filtered_rows = len(df_redu_filtered)
     total_pages = max(1, math.ceil(total_filtered_rows / page_size))
     page_info = f"Page {page_current + 1} of {total_pages}"
     rows_remaining_text = f"{total_filtered_rows} files remaining"
 
-    # Slice data based on current page
-    start_idx = page_current * page_size
-    end_idx = start_idx + page_size
-    paginated_data = df_redu_filtered.iloc[start_idx:end_idx]
+    if approximate:
+        total_pages = max(1, math.ceil(approximate_counts["files"] / page_size))
+        page_info = f"Page {page_current + 1} of ~{total_pages}"
+        rows_remaining_text = "~{} files remaining in at least {} datasets, sample rows shown, exact results loading".format(
+            _approximate_number(approximate_counts["files"]), approximate_counts["ATTRIBUTE_DatasetAccession"])
 
     # Convert paginated data to dictionary format for DataTable
-    paginated_data_dict = paginated_data.to_dict('records')
+    paginated_data_dict = _records(paginated_data, visible_columns)
 
 
     networking_gnps2_url = "https://gnps2.org/workflowinput?workflowname=classical_networking_workflow"
@@ -724,18 +855,30 @@ def update_table_display(page_current, page_size, sort_by, filter_query, selecte
     Input("USIdownload-button", "n_clicks"),
     State("data-table", "filter_query"),
     State("data-table", "columns"),
+    State("fasstmasst-store", "data"),
     prevent_initial_call=True
 )
-def download_filtered_data(n_clicks, n_clicks2, filter_query, visible_columns):
+def download_filtered_data(n_clicks, n_clicks2, filter_query, visible_columns, fasstmasst_data):
     if not n_clicks and not n_clicks2:
         raise PreventUpdate
 
-    df_redu = _load_redu_sampledata()
-    df_redu_filtered = _filter_redu_sampledata(df_redu, filter_query)
+    redu_snapshot = _redu_snapshot()
+    df_redu = redu_snapshot["df"]
+    fasstmasst_row_ids = _fasstmasst_row_ids(redu_snapshot, fasstmasst_data)
 
     ctx = callback_context
+    usi_download = ctx.triggered[0]['prop_id'].split('.')[0] == 'USIdownload-button'
+
+    # Filtered in DuckDB when it is available, reading only the USI column for USI downloads
+    df_redu_filtered = _duckdb_query(redu_snapshot, _duckdb_filtered, filter_query, ["USI"] if usi_download else None, fasstmasst_row_ids)
+
+    if df_redu_filtered is None:
+        df_redu_filtered = _filter_redu_sampledata(df_redu, filter_query)
+
+        if fasstmasst_row_ids is not None:
+            df_redu_filtered = df_redu_filtered[df_redu_filtered.index.isin(fasstmasst_row_ids)]
 
-    if ctx.triggered[0]['prop_id'].split('.')[0] == 'USIdownload-button':
+    if usi_download:
 
         df_redu_filtered = df_redu_filtered.rename(columns={'USI': 'usi'})
 
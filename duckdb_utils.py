@@ -0,0 +1,214 @@
+import threading
+import sys
+
+import numpy as np
+
+import config
+from filter_utils import _filter_clauses
+from ontology_closure_utils import ONTOLOGY_COLUMNS, _is_a_unique_mask
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# DuckDB runs each query on this many threads and spills to disk above the memory limit
+DUCKDB_THREADS = 4
+DUCKDB_MEMORY_LIMIT = "2GB"
+DUCKDB_TEMP_DIRECTORY = "./tempuploads/duckdb"
+
+# One database per process, each request thread queries through its own cursor
+_duckdb_connection = None
+_duckdb_connection_lock = threading.Lock()
+_duckdb_cursors = threading.local()
+
+# Parquet schemas, keyed by path
+_parquet_columns_cache = {}
+
+
+def _duckdb_cursor():
+    global _duckdb_connection
+
+    if _duckdb_connection is None:
+        with _duckdb_connection_lock:
+            if _duckdb_connection is None:
+                connection = duckdb.connect(config={
+                    "threads": DUCKDB_THREADS,
+                    "memory_limit": DUCKDB_MEMORY_LIMIT,
+                    "temp_directory": DUCKDB_TEMP_DIRECTORY,
+                    "enable_object_cache": True,
+                })
+                _duckdb_connection = connection
+
+    if getattr(_duckdb_cursors, "cursor", None) is None:
+        _duckdb_cursors.cursor = _duckdb_connection.cursor()
+
+    return _duckdb_cursors.cursor
+
+
+def _quote_identifier(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def _parquet_relation(parquet_path):
+    # Row numbers in the file are the row ids of the snapshot frame
+    return "read_parquet('{}', file_row_number = true)".format(parquet_path.replace("'", "''"))
+
+
+def _parquet_columns(parquet_path):
+    # Column name to DuckDB type
+    if parquet_path not in _parquet_columns_cache:
+        rows = _duckdb_cursor().execute("DESCRIBE SELECT * FROM {}".format(_parquet_relation(parquet_path))).fetchall()
+        _parquet_columns_cache[parquet_path] = {row[0]: row[1] for row in rows if row[0] != "file_row_number"}
+
+    return _parquet_columns_cache[parquet_path]
+
+
+def _is_a_values(parquet_path, col_name, value):
+    # Distinct values of the column in the ontology subtree, None if the ontology was not built
+    column = _quote_identifier(col_name)
+    uniques = np.array([row[0] for row in _duckdb_cursor().execute(
+        "SELECT DISTINCT {} FROM {} WHERE {} IS NOT NULL".format(column, _parquet_relation(parquet_path), column)).fetchall()], dtype=object)
+    uniques.sort()
+
+    ontology, by = ONTOLOGY_COLUMNS[col_name]
+    unique_mask = _is_a_unique_mask(uniques, ontology, by, value)
+    if unique_mask is None:
+        return None
+
+    return list(uniques[unique_mask])
+
+
+def _clause_sql(parquet_path, columns, col_name, operator, value):
+    # SQL condition and parameters of one clause, same results as the pandas mask of filter_utils, None if it does not filter
+    column = _quote_identifier(col_name)
+
+    if operator in ['contains', 'scontains']:
+        # NULL never matches, like na=False
+        options = 'i' if operator == 'contains' else 'c'
+        return "coalesce(regexp_matches(CAST({} AS VARCHAR), ?, '{}'), false)".format(column, options), [value]
+    elif operator in ['=', 's=']:
+        return "{} = ?".format(column), [value]
+    elif operator in ['!=', 's!=']:
+        return "{} IS DISTINCT FROM ?".format(column), [value]
+    elif operator in ['<', 's<', '<=', 's<=', '>', 's>', '>=', 's>=']:
+        # Non numeric text compares false, like to_numeric with errors='coerce'
+        return "coalesce(TRY_CAST({} AS DOUBLE) {} ?, false)".format(column, operator.lstrip('s')), [float(value)]
+    elif operator in ['is_a', 'not_is_a'] and col_name in ONTOLOGY_COLUMNS:
+        values = _is_a_values(parquet_path, col_name, value)
+        if values is None:
+            return None
+        condition = "coalesce({} IN (SELECT unnest(?)), false)".format(column)
+        return (condition if operator == 'is_a' else "NOT " + condition), [values]
+
+    return None
+
+
+def _where_sql(parquet_path, filter_query, row_ids=None):
+    # None if a filter column is not text, pandas answers those so every filter is compared as text
+    columns = _parquet_columns(parquet_path)
+
+    conditions, parameters = [], []
+    for col_name, operator, value in _filter_clauses(filter_query):
+        if col_name not in columns:
+            continue
+        if columns[col_name] != "VARCHAR":
+            return None
+        clause = _clause_sql(parquet_path, columns, col_name, operator, value)
+        if clause is not None:
+            conditions.append(clause[0])
+            parameters += clause[1]
+
+    # Intersecting with the rows of an MS2 search
+    if row_ids is not None:
+        conditions.append("file_row_number IN (SELECT unnest(?))")
+        parameters.append([int(row_id) for row_id in row_ids])
+
+    if len(conditions) == 0:
+        return "", parameters
+
+    return "WHERE " + " AND ".join("({})".format(condition) for condition in conditions), parameters
+
+
+def _order_sql(columns, sort_by):
+    # Missing values last in both directions like sort_values, ties in snapshot order
+    order_terms = ["{} {} NULLS LAST".format(_quote_identifier(sort_column['column_id']), "ASC" if sort_column['direction'] == 'asc' else "DESC")
+                   for sort_column in sort_by or [] if sort_column['column_id'] in columns]
+
+    return "ORDER BY " + ", ".join(order_terms + ["file_row_number"])
+
+
+def _select_sql(columns, selected_columns):
+    selected_columns = [column for column in selected_columns if column in columns] if selected_columns is not None else list(columns)
+
+    return ", ".join(_quote_identifier(column) for column in selected_columns)
+
+
+def _duckdb_df(sql, parameters):
+    # Results come back as Arrow and are indexed by snapshot row id
+    redu_df = _duckdb_cursor().execute(sql, parameters).fetch_arrow_table().to_pandas()
+
+    return redu_df.set_index("file_row_number").rename_axis(None)
+
+
+def _duckdb_table_page(parquet_path, filter_query, sort_by, page_current, page_size, selected_columns=None, row_ids=None):
+    # Matching row count and one sorted page of the selection table, only the page leaves DuckDB
+    columns = _parquet_columns(parquet_path)
+    where = _where_sql(parquet_path, filter_query, row_ids)
+    if where is None:
+        return None
+    where_sql, parameters = where
+
+    total_rows = _duckdb_cursor().execute("SELECT count(*) FROM {} {}".format(_parquet_relation(parquet_path), where_sql), parameters).fetchone()[0]
+
+    page_sql = "SELECT file_row_number, {} FROM {} {} {} LIMIT ? OFFSET ?".format(
+        _select_sql(columns, selected_columns), _parquet_relation(parquet_path), where_sql, _order_sql(columns, sort_by))
+    page_df = _duckdb_df(page_sql, parameters + [page_size, page_current * page_size])
+
+    return total_rows, page_df
+
+
+def _duckdb_filtered(parquet_path, filter_query, selected_columns=None, row_ids=None):
+    # All matching rows in snapshot order
+    columns = _parquet_columns(parquet_path)
+    where = _where_sql(parquet_path, filter_query, row_ids)
+    if where is None:
+        return None
+    where_sql, parameters = where
+
+    filtered_sql = "SELECT file_row_number, {} FROM {} {} ORDER BY file_row_number".format(
+        _select_sql(columns, selected_columns), _parquet_relation(parquet_path), where_sql)
+
+    return _duckdb_df(filtered_sql, parameters)
+
+
+def _duckdb_term_counts(parquet_path, attribute, filter_query):
+    # Files per term of one text column under a filter, sorted by term, None if a column is not text
+    columns = _parquet_columns(parquet_path)
+    if columns.get(attribute, None) != "VARCHAR":
+        return None
+
+    where = _where_sql(parquet_path, filter_query)
+    if where is None:
+        return None
+    where_sql, parameters = where
+    column = _quote_identifier(attribute)
+
+    counts_sql = "SELECT {} AS term, count(*) AS countfiles FROM {} {} GROUP BY {} HAVING {} IS NOT NULL ORDER BY {}".format(
+        column, _parquet_relation(parquet_path), where_sql, column, column, column)
+
+    return _duckdb_cursor().execute(counts_sql, parameters).fetch_arrow_table().to_pandas()
+
+
+def _duckdb_query(redu_snapshot, query, *args, **kwargs):
+    # Result of a query over the snapshot Parquet file, None when pandas has to answer it instead
+    parquet_path = redu_snapshot.get("path_to_parquet", None)
+    if config.QUERY_BACKEND != "duckdb" or duckdb is None or parquet_path is None:
+        return None
+
+    try:
+        return query(parquet_path, *args, **kwargs)
+    except duckdb.Error as e:
+        # Like regular expressions only Python supports
+        print("DuckDB could not run the query, using pandas", e, file=sys.stderr, flush=True)
+        return None
@@ -0,0 +1,76 @@
+import threading
+
+import numpy as np
+
+from utils import _snapshot_cached
+from filter_utils import _get_coded_columns, _filter_mask, _filter_key
+
+# Facet results, keyed by snapshot version and then by filter, attributes and top
+_facet_cache = {}
+_facet_cache_lock = threading.Lock()
+
+# Facet results kept per snapshot, the oldest is dropped first
+FACET_CACHE_ENTRIES = 512
+
+
+def _facet_attributes(coded_columns, excluded_attributes, attributes=None):
+    # Coded columns only, so unique per file columns like filename and USI are never facets
+    if attributes is None:
+        attributes = list(coded_columns)
+
+    return [attribute for attribute in attributes if attribute in coded_columns and attribute not in excluded_attributes]
+
+
+def _facet_counts(coded_columns, mask, attributes, top):
+    # Term counts of every attribute over the same selected rows, one bincount per coded column
+    row_ids = None if mask.all() else np.flatnonzero(mask)
+
+    facets = {}
+    for attribute in attributes:
+        codes, uniques = coded_columns[attribute]
+        selected_codes = codes if row_ids is None else codes[row_ids]
+
+        # Shifting by one so missing values (-1) land in the first bin, which is left out of the terms
+        counts = np.bincount(selected_codes.astype(np.int64) + 1, minlength=len(uniques) + 1)
+        missing_count = int(counts[0])
+        counts = counts[1:]
+
+        # Most files first, ties by term, sorting only the terms that occur
+        present_codes = np.flatnonzero(counts)
+        top_codes = present_codes[np.lexsort((present_codes, -counts[present_codes]))][:top]
+
+        facets[attribute] = {
+            "terms": [{"attributeterm": str(uniques[code]), "countfiles": int(counts[code])} for code in top_codes],
+            "countterms": len(present_codes),
+            "countother": int(counts.sum() - counts[top_codes].sum()),
+            "countmissing": missing_count,
+        }
+
+    return facets
+
+
+def _redu_facets(redu_snapshot, filter_query, excluded_attributes, attributes=None, top=20):
+    redu_df = redu_snapshot["df"]
+    coded_columns = _get_coded_columns(redu_df, redu_snapshot["version"])
+    attributes = _facet_attributes(coded_columns, excluded_attributes, attributes)
+
+    with _facet_cache_lock:
+        facet_results = _snapshot_cached(_facet_cache, redu_snapshot["version"], dict)
+
+    cache_key = (_filter_key(filter_query), tuple(attributes), top)
+    if cache_key in facet_results:
+        return facet_results[cache_key]
+
+    mask = _filter_mask(redu_df, filter_query, coded_columns)
+
+    result = {
+        "countfiles": int(mask.sum()),
+        "facets": _facet_counts(coded_columns, mask, attributes, top),
+    }
+
+    with _facet_cache_lock:
+        if len(facet_results) >= FACET_CACHE_ENTRIES:
+            del facet_results[next(iter(facet_results))]
+        facet_results[cache_key] = result
+
+    return result
@@ -0,0 +1,92 @@
+import requests
+import hashlib
+import json
+import time
+import sys
+
+import numpy as np
+
+from usi_utils import _scan_usi_to_file_usi, _get_usi_index, _usi_lookup
+
+FASST_API_HOST = "https://api.fasst.gnps2.org"
+FASST_DATABASE = "metabolomicspanrepo_index_nightly"
+
+# Row ids of matched files, keyed by (search key, snapshot version)
+_fasst_row_ids_cache = {}
+
+
+def _fasst_search_key(usi, min_cosine, min_matching_peaks, fragment_tolerance, precursor_tolerance):
+    # Normalizing so that equivalent searches from the UI share one cached result
+    params = {
+        "usi": str(usi).strip(),
+        "min_cosine": round(float(min_cosine), 4),
+        "min_matching_peaks": int(min_matching_peaks),
+        "fragment_tolerance": round(float(fragment_tolerance), 4),
+        "precursor_tolerance": round(float(precursor_tolerance), 4),
+    }
+
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _fasst_task_id(search_key):
+    # Deterministic so that results stored in the celery backend are found again after a web worker restart
+    return "fasst-{}".format(search_key)
+
+
+def query_fasst_usi(usi, min_cosine=0.7, fragment_tolerance=0.02, precursor_tolerance=0.02, timeout=3600, poll_interval=5):
+    params = {
+        "usi": usi,
+        "library": FASST_DATABASE,
+        "analog": "No",
+        "pm_tolerance": precursor_tolerance,
+        "fragment_tolerance": fragment_tolerance,
+        "cosine_threshold": min_cosine,
+        "cache": "Yes",
+    }
+
+    r = requests.post(FASST_API_HOST + "/search", json=params, timeout=60)
+    r.raise_for_status()
+    fasst_task_id = r.json()["id"]
+
+    # Waiting for the search to finish
+    start_time = time.time()
+    while time.time() - start_time < timeout:
+        r = requests.get(FASST_API_HOST + "/search/result/{}".format(fasst_task_id), timeout=60)
+        r.raise_for_status()
+
+        try:
+            return r.json()["results"]
+        except (ValueError, KeyError):
+            print("FASST PENDING", fasst_task_id, file=sys.stderr, flush=True)
+
+        time.sleep(poll_interval)
+
+    raise Exception("FASST search timed out after {} seconds".format(timeout))
+
+
+def _fasst_matched_file_usis(results_list, min_matching_peaks):
+    file_usis = set()
+
+    for result in results_list:
+        if int(result.get("Matching Peaks", 0)) < int(min_matching_peaks):
+            continue
+
+        file_usis.add(_scan_usi_to_file_usi(result["USI"]))
+
+    return sorted(file_usis)
+
+
+def _fasst_row_ids(redu_df, search_key, snapshot_version, load_file_usis):
+    # load_file_usis is only called on a cache miss, it fetches the matched USIs from the celery backend
+    cache_key = (search_key, snapshot_version)
+
+    if cache_key not in _fasst_row_ids_cache:
+        # Dropping row ids that belong to an older snapshot
+        for key in [key for key in _fasst_row_ids_cache if key[1] != snapshot_version]:
+            del _fasst_row_ids_cache[key]
+
+        usi_index = _get_usi_index(redu_df, snapshot_version)
+        _, row_ids, _ = _usi_lookup(usi_index, load_file_usis())
+        _fasst_row_ids_cache[cache_key] = np.unique(row_ids)
+
+    return _fasst_row_ids_cache[cache_key]
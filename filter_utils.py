@@ -0,0 +1,184 @@
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from utils import _snapshot_cached, _register_snapshot_preload
+from ontology_closure_utils import _is_a_mask
+
+# Integer coded columns, keyed by snapshot version
+_coded_columns_cache = {}
+
+# Clauses of a batch of filter queries are evaluated on this many threads, numpy and arrow release the GIL while they run
+FILTER_THREADS = 4
+_filter_executor = ThreadPoolExecutor(max_workers=FILTER_THREADS)
+
+# Columns with more distinct values than this fraction of the rows, like filename and USI, are not coded
+MAX_CODED_DISTINCT_FRACTION = 0.5
+
+
+def _build_coded_columns(redu_df):
+    # Each column as integer codes into its sorted distinct values, missing values are -1
+    coded_columns = {}
+    for column in redu_df.columns:
+        codes, uniques = pd.factorize(redu_df[column], sort=True)
+        if len(uniques) > MAX_CODED_DISTINCT_FRACTION * len(redu_df) and len(redu_df) > 1:
+            continue
+        code_dtype = np.int16 if len(uniques) < np.iinfo(np.int16).max else np.int32
+        coded_columns[column] = (codes.astype(code_dtype), np.asarray(uniques, dtype=object))
+
+    return coded_columns
+
+
+def _get_coded_columns(redu_df, snapshot_version):
+    return _snapshot_cached(_coded_columns_cache, snapshot_version, lambda: _build_coded_columns(redu_df))
+
+
+def _value_code(uniques, value):
+    # Code of a value in the sorted distinct values of a column, None if it does not occur
+    position = np.searchsorted(uniques, value) if len(uniques) > 0 and isinstance(uniques[0], str) else None
+    if position is None or position >= len(uniques) or uniques[position] != value:
+        return None
+
+    return position
+
+
+# Helper function for parsing filtering expressions
+def split_filter_part(filter_part):
+
+    print(filter_part, file=sys.stderr, flush=True)
+    operators = [
+        's>=',
+        's<=',
+        's>',
+        's<',
+        's!=',
+        's=',
+        '>=',
+        '<=',
+        '>',
+        '<',
+        '!=',
+        '=',
+        'contains',
+        'scontains',
+        'datestartswith',
+        'not_is_a',
+        'is_a',
+    ]
+    for operator in operators:
+        regex = r'\{(?P<col_name>[^\}]+)\} ' + re.escape(operator) + r' "?(.+?)"?$'
+        filter_part = filter_part.strip()
+        match = re.match(regex, filter_part)
+        if match:
+            col_name = match.group('col_name')
+            value = match.group(2)
+            operator = operator.strip()
+
+            print(col_name, operator, value, file=sys.stderr, flush=True)
+            return col_name, operator, value
+    return None, None, None
+
+
+def _filter_part_mask(redu_df, col_name, operator, value, coded_columns=None):
+    # Boolean mask of one filter clause over the whole frame, None if the clause does not filter
+    if operator == 'contains':
+        return redu_df[col_name].astype(str).str.contains(value, case=False, na=False, regex=True).to_numpy()
+    elif operator == 'scontains':
+        return redu_df[col_name].astype(str).str.contains(value, case=True, na=False, regex=True).to_numpy()
+    elif operator in ['=', 's=', '!=', 's!=']:
+        if coded_columns is not None and col_name in coded_columns:
+            # Comparing integer codes instead of strings
+            codes, uniques = coded_columns[col_name]
+            value_code = _value_code(uniques, value)
+            equal_mask = codes == value_code if value_code is not None else np.zeros(len(codes), dtype=bool)
+        else:
+            equal_mask = (redu_df[col_name] == value).to_numpy()
+
+        return equal_mask if operator in ['=', 's='] else ~equal_mask
+    elif operator in ['is_a', 'not_is_a']:
+        # Ontology subtree, the term itself and all its descendants
+        is_a_mask = _is_a_mask(redu_df, col_name, value, coded_columns)
+        if is_a_mask is None:
+            return None
+
+        return is_a_mask if operator == 'is_a' else ~is_a_mask
+    elif operator in ['<', 's<']:
+        return (pd.to_numeric(redu_df[col_name], errors='coerce') < float(value)).to_numpy()
+    elif operator in ['<=', 's<=']:
+        return (pd.to_numeric(redu_df[col_name], errors='coerce') <= float(value)).to_numpy()
+    elif operator in ['>', 's>']:
+        return (pd.to_numeric(redu_df[col_name], errors='coerce') > float(value)).to_numpy()
+    elif operator in ['>=', 's>=']:
+        return (pd.to_numeric(redu_df[col_name], errors='coerce') >= float(value)).to_numpy()
+
+    return None
+
+
+def _filter_mask(redu_df, filter_query=None, coded_columns=None):
+    # All clauses of a DataTable filter query, joined by ' && ', as one boolean mask over the frame
+    mask = np.ones(len(redu_df), dtype=bool)
+
+    if filter_query:
+        filtering_expressions = filter_query.split(' && ')
+        for filter_part in filtering_expressions:
+            col_name, operator, value = split_filter_part(filter_part)
+            if operator and col_name in redu_df.columns:
+                part_mask = _filter_part_mask(redu_df, col_name, operator, value, coded_columns)
+                if part_mask is not None:
+                    mask &= part_mask
+
+    return mask
+
+
+def _filter_clauses(filter_query):
+    # Parsed clauses of one filter query, the ones that do not parse are ignored like in the table
+    clauses = []
+    if filter_query:
+        for filter_part in filter_query.split(' && '):
+            col_name, operator, value = split_filter_part(filter_part)
+            if operator:
+                clauses.append((col_name, operator, value))
+
+    return clauses
+
+
+def _filter_masks(redu_df, filter_queries, coded_columns=None):
+    # Masks of many filter queries, clauses shared between queries are evaluated once and all clauses in parallel
+    query_clauses = [_filter_clauses(filter_query) for filter_query in filter_queries]
+    unique_clauses = list(dict.fromkeys(clause for clauses in query_clauses for clause in clauses if clause[0] in redu_df.columns))
+
+    clause_masks = dict(zip(unique_clauses, _filter_executor.map(lambda clause: _filter_part_mask(redu_df, *clause, coded_columns), unique_clauses)))
+
+    masks = []
+    for clauses in query_clauses:
+        mask = np.ones(len(redu_df), dtype=bool)
+        for clause in clauses:
+            if clause_masks.get(clause) is not None:
+                mask &= clause_masks[clause]
+        masks.append(mask)
+
+    return masks
+
+
+def _filter_key(filter_query):
+    # Same key for the same clauses in any order
+    if not filter_query:
+        return ""
+
+    return " && ".join(sorted(filter_part.strip() for filter_part in filter_query.split(' && ')))
+
+
+def _filter_redu_sampledata(redu_df, filter_query=None):
+
+    print(filter_query, file=sys.stderr, flush=True)
+
+    if filter_query:
+        redu_df = redu_df[_filter_mask(redu_df, filter_query)]
+
+    return redu_df
+
+
+_register_snapshot_preload(_get_coded_columns)
@@ -0,0 +1,127 @@
+import functools
+import gzip
+import hashlib
+import os
+
+from flask import Response, make_response, request, send_file
+from werkzeug.http import is_resource_modified
+
+from utils import SNAPSHOT_COMPRESSED_SUFFIXES, _redu_snapshot, _snapshot_cached
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Encoded bodies of per snapshot artifacts, keyed by snapshot version and then by request
+_artifact_cache = {}
+
+
+def _snapshot_etag(version, key=""):
+    # Changes with the snapshot and with whatever else the response depends on
+    return hashlib.sha1("{}\n{}".format(version, key).encode()).hexdigest()
+
+
+def _request_key():
+    return request.full_path
+
+
+def _artifact_key(params=()):
+    # Path and only the parameters the artifact depends on, so unrelated query strings share one entry
+    return "\n".join([request.path] + ["{}={}".format(param, request.values.get(param, "")) for param in params])
+
+
+def _preferred_encoding(encodings):
+    # Best content encoding the client accepts out of the available ones, None for identity
+    accepted = [encoding for encoding in encodings if request.accept_encodings[encoding] > 0]
+    if len(accepted) == 0:
+        return None
+
+    return max(accepted, key=lambda encoding: request.accept_encodings[encoding])
+
+
+def _cache_validators(response, etag, last_modified):
+    # Clients keep the response and revalidate it, which is a 304 until the next snapshot
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    response.vary.add("Accept-Encoding")
+
+    return response
+
+
+def _snapshot_conditional(view):
+    # ETag and Last-Modified validation for views that only depend on the snapshot and the request
+    @functools.wraps(view)
+    def conditional_view(*args, **kwargs):
+        redu_snapshot = _redu_snapshot()
+        etag = _snapshot_etag(redu_snapshot["version"], _request_key())
+        last_modified = redu_snapshot["last_modified"].to_pydatetime()
+
+        # Answering from the validators alone, before anything is computed
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            return _cache_validators(Response(status=304), etag, last_modified)
+
+        response = make_response(view(*args, **kwargs))
+
+        # Artifact responses already carry a validator for their encoding
+        if response.get_etag()[0] is None:
+            _cache_validators(response, etag, last_modified)
+
+        return response
+
+    return conditional_view
+
+
+def _encode_body(body, encoding):
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=10).compress(body)
+
+    return gzip.compress(body, compresslevel=6, mtime=0)
+
+
+def _snapshot_artifact_response(build_body, mimetype="application/json", params=()):
+    # Artifacts are built and compressed once per snapshot, then served with validators and ranges.
+    # params are the request parameters that change the body, every other parameter is ignored.
+    redu_snapshot = _redu_snapshot()
+    artifacts = _snapshot_cached(_artifact_cache, redu_snapshot["version"], dict)
+
+    key = _artifact_key(params)
+    if key not in artifacts:
+        body = build_body()
+        encoded_bodies = {None: body}
+        for encoding in SNAPSHOT_COMPRESSED_SUFFIXES:
+            if encoding == "zstd" and zstandard is None:
+                continue
+            encoded_bodies[encoding] = _encode_body(body, encoding)
+        artifacts[key] = encoded_bodies
+
+    encoding = _preferred_encoding([encoding for encoding in artifacts[key] if encoding is not None])
+
+    response = Response(artifacts[key][encoding], mimetype=mimetype)
+    if encoding is not None:
+        response.content_encoding = encoding
+
+    etag = _snapshot_etag(redu_snapshot["version"], "{}\n{}".format(key, encoding))
+    _cache_validators(response, etag, redu_snapshot["last_modified"].to_pydatetime())
+
+    return response.make_conditional(request, accept_ranges=True)
+
+
+def _send_snapshot_file(path, download_name, mimetype="text/tab-separated-values"):
+    # Sends the precompressed variant the client prefers, each variant has its own ETag so ranges stay consistent
+    redu_snapshot = _redu_snapshot()
+
+    available = [encoding for encoding, suffix in SNAPSHOT_COMPRESSED_SUFFIXES.items() if os.path.exists(path + suffix)]
+    encoding = _preferred_encoding(available)
+
+    response = send_file(path + SNAPSHOT_COMPRESSED_SUFFIXES[encoding] if encoding is not None else path,
+                         mimetype=mimetype, as_attachment=True, download_name=download_name,
+                         conditional=True, etag=_snapshot_etag(redu_snapshot["version"], "{}\n{}".format(path, encoding)),
+                         last_modified=redu_snapshot["last_modified"].to_pydatetime(), max_age=0)
+    if encoding is not None:
+        response.content_encoding = encoding
+    response.cache_control.no_cache = True
+    response.vary.add("Accept-Encoding")
+
+    return response
@@ -0,0 +1,472 @@
+import argparse
+import itertools
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import requests
+
+import config
+import utils
+
+APP_PATH = os.path.dirname(os.path.realpath(__file__))
+
+# Work folder layout, the server runs inside it like it runs inside /app
+SYNTHETIC_TSV = "merged_metadata.tsv"
+SNAPSHOTS_FOLDER = "snapshots"
+WORKFLOW_FOLDER = os.path.join("workflows", "PublicDataset_ReDU_Metadata_Workflow")
+
+# Same first columns as the selection table
+TABLE_COLUMNS = ["SampleType", "SampleTypeSub1", "NCBITaxonomy", "UBERONBodyPartName", "MassSpectrometer", "USI"]
+
+# Requests of each kind, relative to each other
+TRAFFIC_MIX = {
+    "dash_page": 25,
+    "dash_filter": 20,
+    "dash_sort": 15,
+    "attributes": 10,
+    "attributeterms": 15,
+    "status": 10,
+    "download_filtered": 3,
+    "download_dump": 2,
+}
+
+# Filters typed into the selection table
+FILTER_QUERIES = [
+    '{SampleType} = "animal"',
+    '{SampleType} = "plant" && {MassSpectrometer} contains "Q Exactive"',
+    '{NCBITaxonomy} contains "Homo sapiens"',
+    '{UBERONBodyPartName} contains "blood" && {YearOfAnalysis} >= 2020',
+    '{DataSource} = "GNPS" && {SampleTypeSub1} != "missing value"',
+    '{MS2spectra_count} > 1000',
+    '{ATTRIBUTE_DatasetAccession} = "MSV000000001"',
+]
+
+# Attributes asked for their term counts, with or without one filter
+ATTRIBUTE_TERMS_COLUMNS = ["SampleType", "NCBITaxonomy", "UBERONBodyPartName", "MassSpectrometer", "ATTRIBUTE_DatasetAccession"]
+
+# Latency objectives the configurations are checked against, in milliseconds
+LATENCY_SLO_MS = {"p95": 1000, "p99": 3000}
+
+# How often the memory of the server processes is sampled
+RSS_SAMPLE_SECONDS = 0.5
+
+TABLE_OUTPUTS = [("data-table", "data"), ("rows-remaining", "children"), ("page-count", "children"), ("mn-button", "href"),
+                 ("massql-button", "href"), ("dashboard-button", "href"), ("loading-output-232", "children"),
+                 ("exact-table-store", "data")]
+
+
+def _synthetic_metadata(rows, seed):
+    # ReDU like metadata, dataset sizes and term frequencies are skewed like in the real table
+    rng = np.random.default_rng(seed)
+
+    def _skewed_choice(values, size):
+        weights = 1.0 / np.arange(1, len(values) + 1) ** 1.1
+        return rng.choice(np.array(values, dtype=object), size, p=weights / weights.sum())
+
+    datasets = ["MSV{:09d}".format(i) for i in range(2000)] + ["ST{:06d}".format(i) for i in range(200)] + ["MTBLS{}".format(i) for i in range(200)]
+    rng.shuffle(datasets)
+    accessions = _skewed_choice(datasets, rows)
+    filenames = np.array(["f.{}/raw/file_{}.mzML".format(accession, row) for row, accession in enumerate(accessions)], dtype=object)
+
+    metadata_df = pd.DataFrame({
+        "filename": filenames,
+        "ATTRIBUTE_DatasetAccession": accessions,
+        "SampleType": _skewed_choice(["animal", "plant", "environmental", "blank_extraction", "culture_bacterial", "food"], rows),
+        "SampleTypeSub1": _skewed_choice(["blood plasma", "feces", "leaf", "water", "soil", "missing value"], rows),
+        "NCBITaxonomy": _skewed_choice(["9606|Homo sapiens", "10090|Mus musculus", "10116|Rattus norvegicus", "3702|Arabidopsis thaliana", "562|Escherichia coli", "missing value"], rows),
+        "NCBIDivision": _skewed_choice(["Primates", "Rodents", "Plants and Fungi", "Bacteria", "missing value"], rows),
+        "YearOfAnalysis": rng.integers(2012, 2025, rows).astype(str),
+        "MassSpectrometer": _skewed_choice(["Q Exactive|MS:1001911", "Q Exactive HF|MS:1002523", "maXis|MS:1001542", "Orbitrap Fusion|MS:1002416", "impact HD|MS:1002667"], rows),
+        "UBERONBodyPartName": _skewed_choice(["blood plasma", "feces", "blood serum", "urine", "skin of body", "not applicable"], rows),
+        "DOIDCommonName": _skewed_choice(["no DOID available", "diabetes mellitus", "Crohn's disease", "COVID-19", "not applicable"], rows),
+        "DataSource": _skewed_choice(["GNPS", "Metabolomics Workbench", "MetaboLights"], rows),
+        "MS2spectra_count": rng.lognormal(7, 1.5, rows).round(),
+        "ChromatographyAndPhase": _skewed_choice(["reverse phase (C18)", "normal phase (HILIC)", "reverse phase (C8)"], rows),
+        "IonizationSourceAndPolarity": _skewed_choice(["electrospray ionization (positive)", "electrospray ionization (negative)"], rows),
+        "UBERONOntologyIndex": _skewed_choice(["UBERON:0001969", "UBERON:0001988", "UBERON:0001977", "UBERON:0001088", "not applicable"], rows),
+        "DOIDOntologyIndex": _skewed_choice(["not applicable", "DOID:9351", "DOID:8778", "DOID:0080600"], rows),
+        "UniqueSubjectID": np.array(["subject_{}".format(subject) for subject in rng.integers(0, rows // 4 + 1, rows)], dtype=object),
+    })
+
+    return metadata_df
+
+
+def _prepare_work_folder(work_path, rows, seed):
+    # Synthetic snapshot and workflow logs, published the way the worker publishes them
+    os.makedirs(os.path.join(work_path, SNAPSHOTS_FOLDER), exist_ok=True)
+    os.makedirs(os.path.join(work_path, WORKFLOW_FOLDER), exist_ok=True)
+
+    if len(utils._list_snapshot_versions(os.path.join(work_path, SNAPSHOTS_FOLDER))) == 0:
+        synthetic_tsv = os.path.join(work_path, SYNTHETIC_TSV)
+        _synthetic_metadata(rows, seed).to_csv(synthetic_tsv, sep="\t", index=False)
+        utils._publish_snapshot(synthetic_tsv, os.path.join(work_path, SNAPSHOTS_FOLDER))
+
+    with open(os.path.join(work_path, WORKFLOW_FOLDER, ".nextflow.log"), "w") as log_file:
+        log_file.writelines("Oct-01 00:00:{:02d}.000 [main] INFO  nextflow.Session - line {}\n".format(line % 60, line) for line in range(5000))
+    with open(os.path.join(work_path, WORKFLOW_FOLDER, "nextflowstdout.log"), "w") as stdout_file:
+        stdout_file.writelines("[ab/{:06d}] Submitted process > processDataset ({})\n".format(line, line) for line in range(2000))
+    with open(os.path.join(work_path, WORKFLOW_FOLDER, "trace.txt"), "w") as trace_file:
+        trace_file.write("task_id\tname\tstatus\n")
+        trace_file.writelines("{}\tprocessDataset ({})\tCOMPLETED\n".format(task, task) for task in range(2000))
+
+
+class _StubResponse:
+    def __init__(self, payload):
+        self.status_code = 200
+        self.text = json.dumps(payload)
+        self._payload = payload
+
+    def json(self):
+        return self._payload
+
+
+class _OntologyStub:
+    # Stands in for the requests module of ontology_utils, answering like OLS and MassIVE after a fixed delay
+    def __init__(self, delay_seconds):
+        self.delay_seconds = delay_seconds
+
+    def get(self, url, **kwargs):
+        time.sleep(self.delay_seconds)
+        term = url.split("=")[-1].split("&")[0]
+
+        return _StubResponse({"_embedded": {"terms": [{"label": "label of " + term}]}, "title": "title of " + term})
+
+
+def _load_test_app():
+    # gunicorn entry point, run inside the work folder with the ontology HTTP calls stubbed
+    import ontology_utils
+
+    config.PATH_TO_SNAPSHOTS = os.path.abspath(SNAPSHOTS_FOLDER)
+    config.PATH_TO_ORIGINAL_MAPPING_FILE = os.path.abspath(SYNTHETIC_TSV)
+    config.PATH_TO_ONTOLOGY_CLOSURES = os.path.abspath("ontology_closures")
+    config.QUERY_BACKEND = os.environ.get("LOAD_TEST_QUERY_BACKEND", config.QUERY_BACKEND)
+
+    ontology_utils.requests = _OntologyStub(float(os.environ.get("LOAD_TEST_ONTOLOGY_SECONDS", 0)))
+
+    import main
+
+    return main.app
+
+
+def _dash_payload(outputs, inputs, state, changed_prop):
+    output = "...".join("{}.{}".format(*component) for component in outputs)
+
+    return {
+        "output": ".." + output + ".." if len(outputs) > 1 else output,
+        "outputs": [{"id": component, "property": prop} for component, prop in outputs] if len(outputs) > 1 else {"id": outputs[0][0], "property": outputs[0][1]},
+        "inputs": [{"id": component, "property": prop, "value": value} for component, prop, value in inputs],
+        "state": [{"id": component, "property": prop, "value": value} for component, prop, value in state],
+        "changedPropIds": [changed_prop],
+    }
+
+
+def _table_request(columns, page_current=0, sort_by=None, filter_query="", changed_prop="data-table.page_current"):
+    # Same callback the selection table fires when paging, sorting or filtering
+    hidden_columns = [column for column in columns if column not in TABLE_COLUMNS]
+    table_columns = [{"name": column, "id": column, "hideable": True, "clearable": True} for column in columns]
+
+    payload = _dash_payload(TABLE_OUTPUTS, [
+        ("data-table", "page_current", page_current),
+        ("data-table", "page_size", 10),
+        ("data-table", "sort_by", sort_by or []),
+        ("data-table", "filter_query", filter_query),
+        ("data-table", "selected_rows", None),
+        ("network-link-button", "n_clicks", None),
+        ("fasstmasst-store", "data", None),
+        ("data-table", "hidden_columns", hidden_columns),
+        ("approximate-switch", "value", False),
+    ], [("data-table", "columns", table_columns)], changed_prop)
+
+    return "POST", "/selection/_dash-update-component", {"json": payload}
+
+
+def _scenario_request(scenario, rng, columns):
+    # Method, path and request arguments of one request of a scenario
+    if scenario == "dash_page":
+        return _table_request(columns, page_current=int(rng.integers(0, 50)))
+    if scenario == "dash_filter":
+        return _table_request(columns, filter_query=str(rng.choice(FILTER_QUERIES)), changed_prop="data-table.filter_query")
+    if scenario == "dash_sort":
+        sort_by = [{"column_id": str(rng.choice(columns)), "direction": str(rng.choice(["asc", "desc"]))}]
+        filter_query = str(rng.choice(FILTER_QUERIES)) if rng.random() < 0.5 else ""
+        return _table_request(columns, page_current=int(rng.integers(0, 5)), sort_by=sort_by, filter_query=filter_query, changed_prop="data-table.sort_by")
+    if scenario == "attributes":
+        return "GET", "/attributes", {}
+    if scenario == "attributeterms":
+        attribute = str(rng.choice(ATTRIBUTE_TERMS_COLUMNS))
+        filters = [{"attributename": "SampleType", "attributeterm": "animal"}] if rng.random() < 0.5 else []
+        return "GET", "/attribute/{}/attributeterms".format(attribute), {"params": {"filters": json.dumps(filters)}}
+    if scenario == "status":
+        return "GET", "/status.json", {}
+    if scenario == "download_filtered":
+        usi_download = bool(rng.random() < 0.5)
+        payload = _dash_payload([("download-dataframe-csv", "data")], [
+            ("download-button", "n_clicks", None if usi_download else 1),
+            ("USIdownload-button", "n_clicks", 1 if usi_download else None),
+        ], [
+            ("data-table", "filter_query", str(rng.choice(FILTER_QUERIES))),
+            ("data-table", "columns", [{"name": column, "id": column} for column in columns]),
+            ("fasstmasst-store", "data", None),
+        ], "USIdownload-button.n_clicks" if usi_download else "download-button.n_clicks")
+        return "POST", "/selection/_dash-update-component", {"json": payload}
+    if scenario == "download_dump":
+        return "GET", "/dump", {"headers": {"Accept-Encoding": "gzip"}, "stream": True}
+
+    raise ValueError("Unknown scenario {}".format(scenario))
+
+
+def _timed_request(session, base_url, method, path, request_arguments):
+    start_time = time.perf_counter()
+    try:
+        response = session.request(method, base_url + path, timeout=300, **request_arguments)
+        for _ in response.iter_content(1024 * 1024):
+            pass
+        status_code = response.status_code
+    except requests.RequestException:
+        status_code = 0
+
+    return time.perf_counter() - start_time, status_code
+
+
+def _process_tree(pid):
+    # The gunicorn master and its workers, read from /proc
+    parents = {}
+    for process_id in os.listdir("/proc"):
+        if process_id.isdigit():
+            try:
+                with open(os.path.join("/proc", process_id, "stat")) as stat_file:
+                    parents[int(process_id)] = int(stat_file.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+
+    tree = [pid]
+    for process_id in tree:
+        tree.extend(child for child, parent in parents.items() if parent == process_id)
+
+    return tree
+
+
+def _process_rss_bytes(pid):
+    try:
+        with open(os.path.join("/proc", str(pid), "status")) as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return 0
+
+
+class _RssSampler(threading.Thread):
+    # Total resident memory of the server processes, and every worker seen, sampled until stopped
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.samples = []
+        self.worker_pids = set()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            process_tree = _process_tree(self.pid)
+            self.worker_pids.update(process_tree[1:])
+            self.samples.append(sum(_process_rss_bytes(process_id) for process_id in process_tree))
+            self.stopped.wait(RSS_SAMPLE_SECONDS)
+
+
+def _start_server(work_path, port, server_config, log_file):
+    command = [sys.executable, "-m", "gunicorn",
+               "-w", str(server_config["workers"]),
+               "--threads", str(server_config["threads"]),
+               "--worker-class", server_config["worker_class"],
+               "-b", "127.0.0.1:{}".format(port),
+               "--timeout", "120", "--graceful-timeout", "120",
+               "--pythonpath", APP_PATH]
+
+    # Jitter as large as the interval, like in production
+    if server_config["max_requests"] > 0:
+        command += ["--max-requests", str(server_config["max_requests"]), "--max-requests-jitter", str(server_config["max_requests"])]
+
+    command.append("load_test_utils:_load_test_app()")
+
+    environment = dict(os.environ, LOAD_TEST_QUERY_BACKEND=server_config["query_backend"],
+                       LOAD_TEST_ONTOLOGY_SECONDS=str(server_config["ontology_seconds"]))
+
+    return subprocess.Popen(command, cwd=work_path, env=environment, stdout=log_file, stderr=subprocess.STDOUT)
+
+
+def _wait_for_server(base_url, process, timeout_seconds=300):
+    deadline = time.time() + timeout_seconds
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise Exception("Server exited with code {}".format(process.returncode))
+        try:
+            if requests.get(base_url + "/heartbeat", timeout=5).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(1)
+
+    raise Exception("Server did not start in {} seconds".format(timeout_seconds))
+
+
+def _run_load(base_url, columns, traffic_mix, users, requests_per_user, seed):
+    # Closed loop users, each with its own seeded request sequence so runs are repeatable
+    scenarios = list(traffic_mix)
+    weights = np.array([traffic_mix[scenario] for scenario in scenarios], dtype=float)
+    weights /= weights.sum()
+
+    results = [[] for _ in range(users)]
+
+    def _user(user):
+        rng = np.random.default_rng([seed, user])
+        session = requests.Session()
+        for _ in range(requests_per_user):
+            scenario = str(rng.choice(scenarios, p=weights))
+            method, path, request_arguments = _scenario_request(scenario, rng, columns)
+            latency, status_code = _timed_request(session, base_url, method, path, request_arguments)
+            results[user].append((scenario, latency, status_code))
+
+    start_time = time.perf_counter()
+    user_threads = [threading.Thread(target=_user, args=(user,)) for user in range(users)]
+    for user_thread in user_threads:
+        user_thread.start()
+    for user_thread in user_threads:
+        user_thread.join()
+    elapsed_seconds = time.perf_counter() - start_time
+
+    return pd.DataFrame([result for user_results in results for result in user_results], columns=["scenario", "latency", "status_code"]), elapsed_seconds
+
+
+def _latency_summary(results_df):
+    latencies_ms = results_df["latency"].to_numpy() * 1000
+    if len(latencies_ms) == 0:
+        return {"requests": 0, "errors": 0}
+
+    p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99])
+
+    return {
+        "requests": len(results_df),
+        "errors": int(((results_df["status_code"] == 0) | (results_df["status_code"] >= 400)).sum()),
+        # Dropped without a response, like requests caught by a recycled worker
+        "connection_errors": int((results_df["status_code"] == 0).sum()),
+        "p50_ms": round(float(p50), 1),
+        "p95_ms": round(float(p95), 1),
+        "p99_ms": round(float(p99), 1),
+        "max_ms": round(float(latencies_ms.max()), 1),
+    }
+
+
+def run_load_test(work_path, server_configs, traffic_mix=TRAFFIC_MIX, users=12, requests_per_user=50, seed=0, port=5055):
+    # One server per configuration, the same traffic against each, one report entry per configuration
+    base_url = "http://127.0.0.1:{}".format(port)
+    columns = TABLE_COLUMNS + [column for column in pd.read_csv(os.path.join(work_path, SYNTHETIC_TSV), sep="\t", nrows=0).columns if column not in TABLE_COLUMNS]
+    warm_up_rng = np.random.default_rng(seed)
+
+    report = []
+    for server_config in server_configs:
+        print("Load testing", server_config, file=sys.stderr, flush=True)
+
+        with open(os.path.join(work_path, "server-{}.log".format(len(report))), "w") as log_file:
+            process = _start_server(work_path, port, server_config, log_file)
+            try:
+                _wait_for_server(base_url, process)
+
+                # Every kind of request once, so first request costs are not measured
+                for scenario in traffic_mix:
+                    _timed_request(requests.Session(), base_url, *_scenario_request(scenario, warm_up_rng, columns))
+
+                rss_sampler = _RssSampler(process.pid)
+                rss_sampler.start()
+                results_df, elapsed_seconds = _run_load(base_url, columns, traffic_mix, users, requests_per_user, seed)
+                rss_sampler.stopped.set()
+                rss_sampler.join()
+            finally:
+                process.send_signal(signal.SIGTERM)
+                process.wait(timeout=180)
+
+        summary = _latency_summary(results_df)
+        report.append({
+            "config": server_config,
+            "users": users,
+            "duration_seconds": round(elapsed_seconds, 2),
+            "throughput_rps": round(len(results_df) / elapsed_seconds, 2),
+            "latency": summary,
+            "slo_met": all(summary["{}_ms".format(percentile)] <= limit_ms for percentile, limit_ms in LATENCY_SLO_MS.items()) and summary["errors"] == 0,
+            "scenarios": {scenario: _latency_summary(scenario_df) for scenario, scenario_df in results_df.groupby("scenario")},
+            "rss_mb": {
+                "peak": round(max(rss_sampler.samples, default=0) / 1024 / 1024, 1),
+                "mean": round(float(np.mean(rss_sampler.samples)) / 1024 / 1024, 1) if len(rss_sampler.samples) > 0 else 0,
+            },
+            "workers_started": len(rss_sampler.worker_pids),
+        })
+
+    return report
+
+
+def _print_report(report):
+    print("{:<8}{:<9}{:<10}{:<14}{:<9}{:>10}{:>10}{:>10}{:>10}{:>8}{:>10}{:>9}{:>6}".format(
+        "workers", "threads", "class", "max_requests", "backend", "req/s", "p50 ms", "p95 ms", "p99 ms", "errors", "peak MB", "started", "SLO"))
+    for entry in report:
+        server_config, latency = entry["config"], entry["latency"]
+        print("{:<8}{:<9}{:<10}{:<14}{:<9}{:>10}{:>10}{:>10}{:>10}{:>8}{:>10}{:>9}{:>6}".format(
+            server_config["workers"], server_config["threads"], server_config["worker_class"], server_config["max_requests"],
+            server_config["query_backend"], entry["throughput_rps"], latency["p50_ms"], latency["p95_ms"], latency["p99_ms"],
+            latency["errors"], entry["rss_mb"]["peak"], entry["workers_started"], "ok" if entry["slo_met"] else "miss"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test gunicorn configurations of the ReDU web server on synthetic metadata")
+    parser.add_argument("report_json", help="Latency, throughput and memory per configuration")
+    parser.add_argument("--work_path", default=None, help="Folder for the synthetic snapshot and server logs, reused if it already has a snapshot")
+    parser.add_argument("--rows", type=int, default=200000, help="Rows of synthetic metadata")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--threads", type=int, nargs="+", default=[12])
+    parser.add_argument("--worker_classes", nargs="+", default=["gthread"])
+    parser.add_argument("--max_requests", type=int, nargs="+", default=[100, 0], help="Worker recycling interval, 0 never recycles")
+    parser.add_argument("--query_backends", nargs="+", default=[config.QUERY_BACKEND], help="Defaults to the backend of config.py")
+    parser.add_argument("--users", type=int, default=12, help="Concurrent users")
+    parser.add_argument("--requests", type=int, default=50, help="Requests per user")
+    parser.add_argument("--mix", nargs="+", default=None, help="Traffic mix as scenario=weight, for example dash_page=10 status=1")
+    parser.add_argument("--ontology_seconds", type=float, default=0.0, help="Delay of the stubbed ontology lookups")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--port", type=int, default=5055)
+
+    args = parser.parse_args()
+
+    traffic_mix = TRAFFIC_MIX
+    if args.mix is not None:
+        traffic_mix = {scenario: float(weight) for scenario, weight in (scenario_weight.split("=") for scenario_weight in args.mix)}
+
+    work_path = args.work_path or tempfile.mkdtemp(prefix="redu-load-test-")
+    _prepare_work_folder(work_path, args.rows, args.seed)
+
+    server_configs = [{
+        "workers": workers,
+        "threads": threads,
+        "worker_class": worker_class,
+        "max_requests": max_requests,
+        "query_backend": query_backend,
+        "ontology_seconds": args.ontology_seconds,
+    } for workers, threads, worker_class, max_requests, query_backend in itertools.product(
+        args.workers, args.threads, args.worker_classes, args.max_requests, args.query_backends)]
+
+    report = run_load_test(work_path, server_configs, traffic_mix, args.users, args.requests, args.seed, args.port)
+
+    with open(args.report_json, "w") as report_file:
+        json.dump({"rows": args.rows, "seed": args.seed, "traffic_mix": traffic_mix, "slo_ms": LATENCY_SLO_MS, "configurations": report}, report_file, indent=2)
+
+    _print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+import argparse
+import datetime
+import glob
+import json
+import sys
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from usi_build_utils import _derive_usis
+
+# Columns of the per dataset ReDU template, in template order
+TEMPLATE_COLUMNS = ["MassiveID", "filename", "SampleType", "SampleTypeSub1", "NCBITaxonomy", "YearOfAnalysis",
+                    "SampleCollectionMethod", "SampleExtractionMethod", "InternalStandardsUsed", "MassSpectrometer",
+                    "IonizationSourceAndPolarity", "ChromatographyAndPhase", "SubjectIdentifierAsRecorded", "AgeInYears",
+                    "BiologicalSex", "UBERONBodyPartName", "TermsofPosition", "HealthStatus", "DOIDCommonName",
+                    "ComorbidityListDOIDIndex", "SampleCollectionDateandTime", "Country", "HumanPopulationDensity",
+                    "LatitudeandLongitude", "DepthorAltitudeMeters", "qiita_sample_name", "UniqueSubjectID", "LifeStage",
+                    "UBERONOntologyIndex", "DOIDOntologyIndex"]
+
+# Fields of each error record
+ERROR_COLUMNS = ["file", "dataset", "row", "column", "value", "check"]
+
+# Accepted in every column in place of a value
+MISSING_VALUES = ["not applicable", "not collected", "missing value", "no DOID available"]
+
+# Formats of the ontology and identifier columns
+COLUMN_PATTERNS = {
+    "NCBITaxonomy": r"\d+\|.+",
+    "MassSpectrometer": r"[^|]+\|MS:\d{7}",
+    "UBERONOntologyIndex": r"UBERON:\d{7}",
+    "DOIDOntologyIndex": r"DOID:\d+",
+    "ComorbidityListDOIDIndex": r"DOID:\d+(\|DOID:\d+)*",
+    "YearOfAnalysis": r"\d{4}",
+    "LatitudeandLongitude": r"-?\d+(\.\d+)?\|-?\d+(\.\d+)?",
+}
+
+# Inclusive ranges of the numeric columns
+NUMERIC_RANGES = {
+    "YearOfAnalysis": (1990, datetime.date.today().year),
+    "AgeInYears": (0, 130),
+    "DepthorAltitudeMeters": (-11000, 9000),
+}
+
+# Each term has to map to one ontology identifier within a dataset
+PAIRED_COLUMNS = [("UBERONBodyPartName", "UBERONOntologyIndex"), ("DOIDCommonName", "DOIDOntologyIndex")]
+
+# Controlled vocabularies, one set of allowed values per column, compiled once per process
+_vocabularies = {}
+
+
+def _load_vocabularies(vocabularies_path):
+    # One <column>.txt per controlled column with an allowed value per line
+    vocabularies = {}
+    if vocabularies_path is None:
+        return vocabularies
+
+    for vocabulary_filename in glob.glob(os.path.join(vocabularies_path, "*.txt")):
+        column = os.path.splitext(os.path.basename(vocabulary_filename))[0]
+        with open(vocabulary_filename) as vocabulary_file:
+            vocabularies[column] = frozenset(line.strip() for line in vocabulary_file if len(line.strip()) > 0)
+
+    return vocabularies
+
+
+def _set_vocabularies(vocabularies):
+    global _vocabularies
+    _vocabularies = vocabularies
+
+
+def _row_errors(metadata_df, invalid, column, check):
+    # Error records of the rows flagged in a boolean mask, rows are numbered like the lines of the TSV
+    rows = np.flatnonzero(invalid)
+
+    return pd.DataFrame({
+        "row": rows + 2,
+        "column": column,
+        "value": metadata_df[column].to_numpy()[rows] if column in metadata_df.columns else None,
+        "check": check,
+    })
+
+
+def _file_errors(errors_df, metadata_path, dataset):
+    errors_df.insert(0, "dataset", dataset)
+    errors_df.insert(0, "file", metadata_path)
+
+    return errors_df
+
+
+def _validate_metadata_file(metadata_path):
+    dataset = os.path.splitext(os.path.basename(metadata_path))[0]
+    errors = []
+
+    try:
+        metadata_df = pd.read_csv(metadata_path, sep="\t", dtype=str, keep_default_na=False)
+    except Exception as e:
+        errors_df = pd.DataFrame([{"row": None, "column": None, "value": str(e), "check": "unreadable"}])
+        return dataset, None, _file_errors(errors_df, metadata_path, dataset)
+
+    # Schema
+    missing_columns = [column for column in TEMPLATE_COLUMNS if column not in metadata_df.columns]
+    if len(missing_columns) > 0:
+        errors_df = pd.DataFrame([{"row": 1, "column": column, "value": None, "check": "missing_column"} for column in missing_columns])
+        return dataset, None, _file_errors(errors_df, metadata_path, dataset)
+
+    metadata_df = metadata_df[TEMPLATE_COLUMNS].apply(lambda values: values.str.strip())
+    missing = {column: metadata_df[column].isin(MISSING_VALUES).to_numpy() for column in TEMPLATE_COLUMNS}
+
+    errors.append(_row_errors(metadata_df, (metadata_df["MassiveID"] != dataset).to_numpy(), "MassiveID", "dataset_mismatch"))
+    errors.append(_row_errors(metadata_df, (metadata_df["filename"] == "").to_numpy(), "filename", "empty"))
+    errors.append(_row_errors(metadata_df, metadata_df["filename"].duplicated(keep=False).to_numpy(), "filename", "duplicated"))
+
+    for column in TEMPLATE_COLUMNS:
+        errors.append(_row_errors(metadata_df, (metadata_df[column] == "").to_numpy(), column, "empty"))
+
+    for column, pattern in COLUMN_PATTERNS.items():
+        invalid = ~metadata_df[column].str.fullmatch(pattern).to_numpy() & ~missing[column] & (metadata_df[column] != "").to_numpy()
+        errors.append(_row_errors(metadata_df, invalid, column, "format"))
+
+    for column, (minimum, maximum) in NUMERIC_RANGES.items():
+        values = pd.to_numeric(metadata_df[column], errors="coerce").to_numpy()
+        present = ~missing[column] & (metadata_df[column] != "").to_numpy()
+        errors.append(_row_errors(metadata_df, present & np.isnan(values), column, "not_numeric"))
+        errors.append(_row_errors(metadata_df, present & ((values < minimum) | (values > maximum)), column, "out_of_range"))
+
+    for column, vocabulary in _vocabularies.items():
+        if column in metadata_df.columns:
+            invalid = ~metadata_df[column].isin(vocabulary).to_numpy() & ~missing[column] & (metadata_df[column] != "").to_numpy()
+            errors.append(_row_errors(metadata_df, invalid, column, "vocabulary"))
+
+    # A term with several identifiers is usually a spreadsheet fill that incremented the identifier
+    term_columns = PAIRED_COLUMNS + [("MassSpectrometer", None)]
+    for term_column, identifier_column in term_columns:
+        terms = metadata_df[term_column] if identifier_column is not None else metadata_df[term_column].str.split("|").str[0]
+        identifiers = metadata_df[identifier_column] if identifier_column is not None else metadata_df[term_column]
+        identifier_counts = identifiers.groupby(terms).transform("nunique").to_numpy()
+        errors.append(_row_errors(metadata_df, (identifier_counts > 1) & ~missing[term_column], identifier_column or term_column, "inconsistent_identifier"))
+
+    errors_df = _file_errors(pd.concat(errors, ignore_index=True), metadata_path, dataset)
+
+    # Rows with errors are left out of the merged metadata
+    metadata_df = metadata_df[~np.isin(np.arange(len(metadata_df)) + 2, errors_df["row"].to_numpy())]
+    metadata_df.insert(0, "ATTRIBUTE_DatasetAccession", dataset)
+
+    return dataset, metadata_df, errors_df
+
+
+def validate_and_merge_metadata(metadata_paths, vocabularies=None, processes=None):
+    # Validates the per dataset templates in parallel, then checks across datasets while merging
+    vocabularies = vocabularies or {}
+
+    with ProcessPoolExecutor(max_workers=processes, initializer=_set_vocabularies, initargs=(vocabularies,)) as executor:
+        results = list(executor.map(_validate_metadata_file, metadata_paths, chunksize=16))
+
+    merged_results = [(metadata_path, metadata_df) for metadata_path, (_, metadata_df, _) in zip(metadata_paths, results) if metadata_df is not None]
+    errors_df = pd.concat([pd.DataFrame(columns=ERROR_COLUMNS)] + [errors_df for _, _, errors_df in results], ignore_index=True)
+
+    # No file left a row to merge
+    if len(merged_results) == 0:
+        return pd.DataFrame(columns=["ATTRIBUTE_DatasetAccession"] + TEMPLATE_COLUMNS, dtype=str), errors_df
+
+    merged_df = pd.concat([metadata_df for _, metadata_df in merged_results], ignore_index=True)
+
+    # Where each merged row comes from, rows are numbered like the lines of their TSV
+    merged_files = np.concatenate([np.repeat(metadata_path, len(metadata_df)) for metadata_path, metadata_df in merged_results])
+    merged_rows = np.concatenate([metadata_df.index.to_numpy() + 2 for _, metadata_df in merged_results])
+
+    # Files are published by USI, two rows with the same USI in any of the templates would publish the same file twice
+    usis = _derive_usis(merged_df["ATTRIBUTE_DatasetAccession"], merged_df["filename"])
+    duplicated = usis.duplicated(keep=False).to_numpy()
+    if duplicated.any():
+        errors_df = pd.concat([errors_df, pd.DataFrame({
+            "file": merged_files[duplicated],
+            "dataset": merged_df["ATTRIBUTE_DatasetAccession"].to_numpy()[duplicated],
+            "row": merged_rows[duplicated],
+            "column": "filename",
+            "value": usis.to_numpy()[duplicated],
+            "check": "duplicated_usi",
+        })], ignore_index=True)
+        merged_df = merged_df[~duplicated]
+
+    return merged_df.reset_index(drop=True), errors_df
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate and merge per dataset ReDU metadata templates")
+    parser.add_argument("metadata_path", help="Folder of per dataset TSV templates, subfolders included")
+    parser.add_argument("output_feather", help="Merged metadata of the rows without errors")
+    parser.add_argument("report_json", help="Errors, one record per row and check")
+    parser.add_argument("--vocabularies", default=None, help="Folder with an allowed values file <column>.txt per controlled column")
+    parser.add_argument("--processes", type=int, default=None)
+
+    args = parser.parse_args()
+
+    metadata_paths = sorted(glob.glob(os.path.join(args.metadata_path, "**", "*.tsv"), recursive=True))
+    merged_df, errors_df = validate_and_merge_metadata(metadata_paths, _load_vocabularies(args.vocabularies), args.processes)
+
+    merged_df.to_feather(args.output_feather)
+
+    report = {
+        "files": len(metadata_paths),
+        "merged_rows": len(merged_df),
+        "errors": len(errors_df),
+        "errors_by_check": {check: int(count) for check, count in errors_df["check"].value_counts().items()},
+        "records": errors_df.astype(object).where(errors_df.notna(), None).to_dict(orient="records"),
+    }
+    with open(args.report_json, "w") as report_file:
+        json.dump(report, report_file, indent=2)
+
+    print("Merged", len(merged_df), "rows from", len(metadata_paths), "files with", len(errors_df), "errors", file=sys.stderr, flush=True)
+
+
+if __name__ == '__main__':
+    main()
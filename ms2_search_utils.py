@@ -0,0 +1,266 @@
+import requests
+import argparse
+import json
+import sys
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+# Index layout, every array is saved as its own .npy so search processes can memory map them
+INDEX_ARRAYS = ["precursor_mz", "file_ids", "peak_offsets", "peak_mz", "peak_intensity"]
+INDEX_USIS = "usis.json"
+
+# Only the most intense peaks of each spectrum are kept in the per-file summaries
+MAX_PEAKS_PER_SPECTRUM = 50
+
+# Number of candidate spectra scored per batch
+SEARCH_BATCH_SIZE = 200000
+
+
+def _normalize_peaks(mz_array, intensity_array, max_peaks=MAX_PEAKS_PER_SPECTRUM):
+    mz_array = np.asarray(mz_array, dtype=np.float32)
+    intensity_array = np.asarray(intensity_array, dtype=np.float32)
+
+    keep = intensity_array > 0
+    mz_array, intensity_array = mz_array[keep], intensity_array[keep]
+
+    if len(intensity_array) > max_peaks:
+        top = np.argpartition(intensity_array, -max_peaks)[-max_peaks:]
+        mz_array, intensity_array = mz_array[top], intensity_array[top]
+
+    # Square root scaling and unit norm, so the cosine is the sum of matched peak products
+    intensity_array = np.sqrt(intensity_array)
+    norm = np.sqrt(np.sum(intensity_array ** 2))
+    if norm > 0:
+        intensity_array = intensity_array / norm
+
+    order = np.argsort(mz_array)
+
+    return mz_array[order], intensity_array[order]
+
+
+def read_mgf_spectra(mgf_path):
+    # Yields (precursor_mz, mz_array, intensity_array) for every spectrum in an MGF file
+    precursor_mz = None
+    peaks = []
+    in_spectrum = False
+
+    with open(mgf_path) as mgf_file:
+        for line in mgf_file:
+            line = line.strip()
+
+            if line == "BEGIN IONS":
+                in_spectrum = True
+                precursor_mz = None
+                peaks = []
+            elif line == "END IONS":
+                in_spectrum = False
+                if precursor_mz is not None and len(peaks) > 0:
+                    peaks_array = np.array(peaks, dtype=np.float32)
+                    yield precursor_mz, peaks_array[:, 0], peaks_array[:, 1]
+            elif in_spectrum:
+                if line.startswith("PEPMASS="):
+                    precursor_mz = float(line.split("=", 1)[1].split()[0])
+                elif len(line) > 0 and line[0].isdigit():
+                    values = line.split()
+                    peaks.append((float(values[0]), float(values[1])))
+
+
+def build_ms2_index(spectra, output_path, max_peaks=MAX_PEAKS_PER_SPECTRUM):
+    # spectra is an iterable of (file_usi, precursor_mz, mz_array, intensity_array)
+    usi_to_file_id = {}
+    precursor_list = []
+    file_id_list = []
+    length_list = []
+    mz_list = []
+    intensity_list = []
+
+    for file_usi, precursor_mz, mz_array, intensity_array in spectra:
+        mz_array, intensity_array = _normalize_peaks(mz_array, intensity_array, max_peaks=max_peaks)
+        if len(mz_array) == 0:
+            continue
+
+        file_id = usi_to_file_id.setdefault(file_usi, len(usi_to_file_id))
+
+        precursor_list.append(precursor_mz)
+        file_id_list.append(file_id)
+        length_list.append(len(mz_array))
+        mz_list.append(mz_array)
+        intensity_list.append(intensity_array)
+
+    precursor_mz = np.array(precursor_list, dtype=np.float64)
+    file_ids = np.array(file_id_list, dtype=np.int32)
+    lengths = np.array(length_list, dtype=np.int64)
+    peak_mz = np.concatenate(mz_list) if mz_list else np.zeros(0, dtype=np.float32)
+    peak_intensity = np.concatenate(intensity_list) if intensity_list else np.zeros(0, dtype=np.float32)
+
+    # Sorting spectra by precursor m/z and moving their peaks along in one gather
+    order = np.argsort(precursor_mz, kind="stable")
+    old_starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]) if len(lengths) > 0 else lengths
+    sorted_lengths = lengths[order]
+    peak_offsets = np.concatenate([[0], np.cumsum(sorted_lengths)]).astype(np.int64)
+    gather = np.repeat(old_starts[order] - peak_offsets[:-1], sorted_lengths) + np.arange(peak_offsets[-1])
+
+    index = {
+        "precursor_mz": precursor_mz[order],
+        "file_ids": file_ids[order],
+        "peak_offsets": peak_offsets,
+        "peak_mz": peak_mz[gather],
+        "peak_intensity": peak_intensity[gather],
+    }
+
+    os.makedirs(output_path, exist_ok=True)
+    for array_name in INDEX_ARRAYS:
+        np.save(os.path.join(output_path, array_name + ".npy"), index[array_name])
+
+    with open(os.path.join(output_path, INDEX_USIS), "w") as usis_file:
+        json.dump(sorted(usi_to_file_id, key=usi_to_file_id.get), usis_file)
+
+    print("Indexed", len(precursor_mz), "spectra from", len(usi_to_file_id), "files", file=sys.stderr, flush=True)
+
+    return index
+
+
+def load_ms2_index(index_path):
+    index = {array_name: np.load(os.path.join(index_path, array_name + ".npy"), mmap_mode="r") for array_name in INDEX_ARRAYS}
+
+    with open(os.path.join(index_path, INDEX_USIS)) as usis_file:
+        index["usis"] = json.load(usis_file)
+
+    return index
+
+
+def _score_spectra(index, start, end, query_mz, query_intensity, fragment_tolerance, min_cosine, min_matching_peaks):
+    # Returns the file ids of the spectra in [start, end) matching the query
+    peak_start, peak_end = int(index["peak_offsets"][start]), int(index["peak_offsets"][end])
+    if peak_end == peak_start or len(query_mz) == 0:
+        return np.zeros(0, dtype=np.int32)
+
+    candidate_mz = np.asarray(index["peak_mz"][peak_start:peak_end])
+    candidate_intensity = np.asarray(index["peak_intensity"][peak_start:peak_end])
+    spectrum_ids = np.repeat(np.arange(end - start), np.diff(index["peak_offsets"][start:end + 1]))
+
+    # Nearest query peak for every candidate peak
+    right = np.clip(np.searchsorted(query_mz, candidate_mz), 1, len(query_mz) - 1) if len(query_mz) > 1 else np.zeros(len(candidate_mz), dtype=np.int64)
+    left = np.maximum(right - 1, 0)
+    use_left = np.abs(candidate_mz - query_mz[left]) <= np.abs(candidate_mz - query_mz[right])
+    nearest = np.where(use_left, left, right)
+    matched = np.abs(candidate_mz - query_mz[nearest]) <= fragment_tolerance
+
+    spectrum_ids = spectrum_ids[matched]
+    nearest = nearest[matched]
+    products = candidate_intensity[matched] * query_intensity[nearest]
+
+    # Each query peak is matched at most once per spectrum, keeping the largest product
+    pair_keys = spectrum_ids.astype(np.int64) * len(query_mz) + nearest
+    order = np.lexsort((-products, pair_keys))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = pair_keys[order][1:] != pair_keys[order][:-1]
+    order = order[first]
+
+    scores = np.bincount(spectrum_ids[order], weights=products[order], minlength=end - start)
+    matching_peaks = np.bincount(spectrum_ids[order], minlength=end - start)
+
+    hits = np.flatnonzero((scores >= min_cosine) & (matching_peaks >= min_matching_peaks))
+
+    return np.asarray(index["file_ids"][start + hits])
+
+
+def _score_batch(index_path, start, end, query_mz, query_intensity, fragment_tolerance, min_cosine, min_matching_peaks):
+    index = load_ms2_index(index_path)
+    return _score_spectra(index, start, end, query_mz, query_intensity, fragment_tolerance, min_cosine, min_matching_peaks)
+
+
+def search_ms2_index(index_path, precursor_mz, mz_array, intensity_array, \
+                     precursor_tolerance=0.02, fragment_tolerance=0.02, \
+                     min_cosine=0.7, min_matching_peaks=6, \
+                     processes=None, batch_size=SEARCH_BATCH_SIZE):
+    index = load_ms2_index(index_path)
+    query_mz, query_intensity = _normalize_peaks(mz_array, intensity_array)
+
+    # Candidates are the contiguous run of spectra within the precursor tolerance
+    start = int(np.searchsorted(index["precursor_mz"], precursor_mz - precursor_tolerance, side="left"))
+    end = int(np.searchsorted(index["precursor_mz"], precursor_mz + precursor_tolerance, side="right"))
+
+    batches = [(batch_start, min(batch_start + batch_size, end)) for batch_start in range(start, end, batch_size)]
+    score_args = (query_mz, query_intensity, fragment_tolerance, min_cosine, min_matching_peaks)
+
+    if processes == 1 or len(batches) <= 1:
+        matched_file_ids = [_score_spectra(index, batch_start, batch_end, *score_args) for batch_start, batch_end in batches]
+    else:
+        # Daemonic processes (e.g. celery prefork children) cannot fork a pool, numpy releases the GIL so threads still scale
+        executor_class = ThreadPoolExecutor if multiprocessing.current_process().daemon else ProcessPoolExecutor
+
+        with executor_class(max_workers=processes) as executor:
+            futures = [executor.submit(_score_batch, index_path, batch_start, batch_end, *score_args) for batch_start, batch_end in batches]
+            matched_file_ids = [future.result() for future in futures]
+
+    if len(matched_file_ids) == 0:
+        return []
+
+    matched_file_ids = np.unique(np.concatenate(matched_file_ids))
+
+    return [index["usis"][file_id] for file_id in matched_file_ids]
+
+
+def _fetch_usi_spectrum(usi):
+    # Resolving the query spectrum peaks through the GNPS2 USI resolver
+    r = requests.get("https://metabolomics-usi.gnps2.org/json/", params={"usi1": usi}, timeout=60)
+    r.raise_for_status()
+    spectrum_json = r.json()
+
+    peaks_array = np.array(spectrum_json["peaks"], dtype=np.float32).reshape(-1, 2)
+
+    return float(spectrum_json["precursor_mz"]), peaks_array[:, 0], peaks_array[:, 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local MS2 spectral similarity index for ReDU files")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Build the index from per-file MGF summaries")
+    build_parser.add_argument("input_tsv", help="TSV with the columns usi and mgf_path")
+    build_parser.add_argument("index_path")
+    build_parser.add_argument("--max_peaks", type=int, default=MAX_PEAKS_PER_SPECTRUM)
+
+    search_parser = subparsers.add_parser("search", help="Search a USI against the index")
+    search_parser.add_argument("index_path")
+    search_parser.add_argument("usi")
+    search_parser.add_argument("--precursor_tolerance", type=float, default=0.02)
+    search_parser.add_argument("--fragment_tolerance", type=float, default=0.02)
+    search_parser.add_argument("--min_cosine", type=float, default=0.7)
+    search_parser.add_argument("--min_matching_peaks", type=int, default=6)
+    search_parser.add_argument("--processes", type=int, default=None)
+
+    args = parser.parse_args()
+
+    if args.command == "build":
+        import pandas as pd
+
+        files_df = pd.read_csv(args.input_tsv, sep="\t")
+
+        def _all_spectra():
+            for file_usi, mgf_path in zip(files_df["usi"], files_df["mgf_path"]):
+                for precursor_mz, mz_array, intensity_array in read_mgf_spectra(mgf_path):
+                    yield file_usi, precursor_mz, mz_array, intensity_array
+
+        build_ms2_index(_all_spectra(), args.index_path, max_peaks=args.max_peaks)
+
+    if args.command == "search":
+        precursor_mz, mz_array, intensity_array = _fetch_usi_spectrum(args.usi)
+
+        matched_usis = search_ms2_index(args.index_path, precursor_mz, mz_array, intensity_array, \
+                                        precursor_tolerance=args.precursor_tolerance, \
+                                        fragment_tolerance=args.fragment_tolerance, \
+                                        min_cosine=args.min_cosine, \
+                                        min_matching_peaks=args.min_matching_peaks, \
+                                        processes=args.processes)
+
+        for usi in matched_usis:
+            print(usi)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+import config
+
+# Columns that can be filtered by ontology subtree, with their ontology and how a cell names a term
+ONTOLOGY_COLUMNS = {
+    "UBERONBodyPartName": ("uberon", "label"),
+    "UBERONOntologyIndex": ("uberon", "id"),
+    "DOIDCommonName": ("doid", "label"),
+    "DOIDOntologyIndex": ("doid", "id"),
+    "NCBITaxonomy": ("ncbitaxon", "taxonomy"),
+}
+
+# Identifier prefix of the terms kept from each OBO file
+OBO_PREFIXES = {"uberon": "UBERON:", "doid": "DOID:"}
+
+# Closure tables, keyed by ontology, loaded once per process
+_ontology_closures = {}
+
+
+def _read_obo(obo_path, prefix):
+    # Terms and is_a edges of an OBO file, obsolete terms and terms of imported ontologies are left out
+    ids, labels, edges = [], [], []
+
+    def _add_term(term):
+        if term.get("id", "").startswith(prefix) and not term.get("is_obsolete", False):
+            ids.append(term["id"])
+            labels.append(term.get("name", term["id"]))
+            edges.extend((term["id"], parent) for parent in term.get("is_a", []) if parent.startswith(prefix))
+
+    term = None
+    with open(obo_path) as obo_file:
+        for line in obo_file:
+            line = line.strip()
+            if line.startswith("["):
+                if term is not None:
+                    _add_term(term)
+                term = {} if line == "[Term]" else None
+            elif term is not None and ": " in line:
+                key, value = line.split(": ", 1)
+                if key in ["id", "name"]:
+                    term[key] = value
+                elif key == "is_a":
+                    term.setdefault("is_a", []).append(value.split(" ")[0])
+                elif key == "is_obsolete":
+                    term["is_obsolete"] = value == "true"
+    if term is not None:
+        _add_term(term)
+
+    return ids, labels, edges
+
+
+def _read_ncbi_taxonomy(nodes_path, names_path):
+    # nodes.dmp and names.dmp of the NCBI taxonomy dump, labeled by scientific name
+    nodes_df = pd.read_csv(nodes_path, sep="|", header=None, usecols=[0, 1], names=["id", "parent"], dtype=str)
+    names_df = pd.read_csv(names_path, sep="|", header=None, usecols=[0, 1, 3], names=["id", "name", "name_class"], dtype=str, quoting=3)
+
+    nodes_df = nodes_df.apply(lambda values: values.str.strip())
+    names_df = names_df.apply(lambda values: values.str.strip())
+    names_df = names_df[names_df["name_class"] == "scientific name"].drop_duplicates("id")
+
+    labels = nodes_df["id"].map(names_df.set_index("id")["name"]).fillna(nodes_df["id"])
+
+    # The root is its own parent
+    edges_df = nodes_df[nodes_df["id"] != nodes_df["parent"]]
+
+    return list(nodes_df["id"]), list(labels), list(zip(edges_df["id"], edges_df["parent"]))
+
+
+def _merge_intervals(intervals):
+    # Sorted, non overlapping and non adjacent inclusive intervals
+    merged = []
+    for low, high in sorted(intervals):
+        if len(merged) > 0 and low <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], high))
+        else:
+            merged.append((low, high))
+
+    return merged
+
+
+def _interval_encoding(ids, edges):
+    # Postorder number of every term and the intervals of numbers its descendants (and itself) fall into.
+    # A spanning tree gives each term one interval, terms with several parents add intervals to their other ancestors.
+    positions = {term_id: position for position, term_id in enumerate(ids)}
+    children = [[] for _ in ids]
+    has_parent = np.zeros(len(ids), dtype=bool)
+    for child, parent in edges:
+        if child in positions and parent in positions:
+            children[positions[parent]].append(positions[child])
+            has_parent[positions[child]] = True
+
+    numbers = np.full(len(ids), -1, dtype=np.int64)
+    lows = np.zeros(len(ids), dtype=np.int64)
+    extra_children = [[] for _ in ids]
+    order = []
+    visited = np.zeros(len(ids), dtype=bool)
+    counter = 0
+
+    for root in np.flatnonzero(~has_parent):
+        visited[root] = True
+        lows[root] = counter
+        stack = [(root, 0)]
+        while len(stack) > 0:
+            node, child_index = stack[-1]
+            if child_index < len(children[node]):
+                stack[-1] = (node, child_index + 1)
+                child = children[node][child_index]
+                if visited[child]:
+                    extra_children[node].append(child)
+                else:
+                    visited[child] = True
+                    lows[child] = counter
+                    stack.append((child, 0))
+            else:
+                stack.pop()
+                numbers[node] = counter
+                counter += 1
+                order.append(node)
+
+    # Every child is numbered before its parents, so intervals are complete when a term is reached
+    extra_intervals = [[] for _ in ids]
+    for node in order:
+        tree_interval = (lows[node], numbers[node])
+        intervals = []
+        for child in children[node]:
+            intervals.extend(extra_intervals[child])
+        for child in extra_children[node]:
+            intervals.append((lows[child], numbers[child]))
+        outside = [interval for interval in intervals if interval[0] < tree_interval[0] or interval[1] > tree_interval[1]]
+        if len(outside) > 0:
+            extra_intervals[node] = [interval for interval in _merge_intervals(outside + [tree_interval]) if interval != tree_interval]
+
+    # Terms on a cycle are never reached from a root and are left out
+    rows = []
+    for node in order:
+        for low, high in _merge_intervals([(lows[node], numbers[node])] + extra_intervals[node]):
+            rows.append((ids[node], numbers[node], low, high))
+
+    return pd.DataFrame(rows, columns=["id", "number", "low", "high"])
+
+
+def build_ontology_closure(ids, labels, edges):
+    # One row per interval of every term, sorted by identifier
+    closure_df = _interval_encoding(ids, edges)
+    closure_df.insert(1, "label", closure_df["id"].map(dict(zip(ids, labels))))
+
+    return closure_df.sort_values(["id", "low"], kind="stable").reset_index(drop=True)
+
+
+def _load_ontology_closure(ontology):
+    closure_filename = os.path.join(config.PATH_TO_ONTOLOGY_CLOSURES, "{}.feather".format(ontology))
+    if not os.path.exists(closure_filename):
+        return None
+
+    closure_df = pd.read_feather(closure_filename)
+
+    sorted_labels = closure_df["label"].astype(str).str.lower().to_numpy(dtype=object)
+    label_order = np.argsort(sorted_labels, kind="stable")
+
+    return {
+        "ids": closure_df["id"].astype(str).to_numpy(dtype=object),
+        "labels": sorted_labels[label_order],
+        "label_order": label_order,
+        "numbers": closure_df["number"].to_numpy(),
+        "lows": closure_df["low"].to_numpy(),
+        "highs": closure_df["high"].to_numpy(),
+    }
+
+
+def _get_ontology_closure(ontology):
+    if ontology not in _ontology_closures:
+        _ontology_closures[ontology] = _load_ontology_closure(ontology)
+
+    return _ontology_closures[ontology]
+
+
+def _matching_rows(sorted_keys, key_rows, queries):
+    # (query position, closure row) pairs of all rows whose key equals a query
+    starts = np.searchsorted(sorted_keys, queries, side="left")
+    ends = np.searchsorted(sorted_keys, queries, side="right")
+
+    lengths = ends - starts
+    query_positions = np.repeat(np.arange(len(queries)), lengths)
+    offsets = np.arange(len(query_positions)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+    return query_positions, key_rows[np.repeat(starts, lengths) + offsets]
+
+
+def _term_rows(closure, terms, by):
+    terms = np.asarray(terms, dtype=object)
+    if by == "label":
+        return _matching_rows(closure["labels"], closure["label_order"], np.array([term.lower() for term in terms], dtype=object))
+
+    if by == "taxonomy":
+        terms = np.array([term.split("|")[0] for term in terms], dtype=object)
+
+    return _matching_rows(closure["ids"], np.arange(len(closure["ids"])), terms)
+
+
+def _is_a_unique_mask(uniques, ontology, by, value):
+    # Which distinct values of a column are the term or below it, None if the ontology was not built
+    closure = _get_ontology_closure(ontology)
+    if closure is None:
+        print("No closure table for", ontology, file=sys.stderr, flush=True)
+        return None
+
+    # A filter value is an identifier or a label, labels can name several terms
+    _, id_rows = _term_rows(closure, [value], "taxonomy" if by == "taxonomy" else "id")
+    _, label_rows = _term_rows(closure, [value], "label")
+    term_rows = np.union1d(id_rows, label_rows)
+
+    unique_mask = np.zeros(len(uniques), dtype=bool)
+    if len(term_rows) == 0:
+        return unique_mask
+
+    merged_intervals = np.array(_merge_intervals(zip(closure["lows"][term_rows], closure["highs"][term_rows])), dtype=np.int64)
+
+    # Range checks of the postorder numbers of the distinct values
+    string_positions = np.array([position for position, unique in enumerate(uniques) if isinstance(unique, str)], dtype=np.int64)
+    unique_positions, unique_rows = _term_rows(closure, uniques[string_positions], by)
+    unique_numbers = closure["numbers"][unique_rows]
+
+    interval_positions = np.searchsorted(merged_intervals[:, 0], unique_numbers, side="right") - 1
+    inside = (interval_positions >= 0) & (unique_numbers <= merged_intervals[np.maximum(interval_positions, 0), 1])
+
+    unique_mask[string_positions[unique_positions[inside]]] = True
+
+    return unique_mask
+
+
+def _is_a_mask(redu_df, col_name, value, coded_columns=None):
+    # Rows whose term is the filter term or one of its descendants, None if the column has no ontology
+    if col_name not in ONTOLOGY_COLUMNS:
+        return None
+
+    if coded_columns is not None and col_name in coded_columns:
+        codes, uniques = coded_columns[col_name]
+    else:
+        codes, uniques = pd.factorize(redu_df[col_name], sort=True)
+        uniques = np.asarray(uniques, dtype=object)
+
+    ontology, by = ONTOLOGY_COLUMNS[col_name]
+    unique_mask = _is_a_unique_mask(uniques, ontology, by, value)
+    if unique_mask is None:
+        return None
+
+    # Missing values are coded -1 and land on the appended False
+    return np.append(unique_mask, False)[codes]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the ontology closure tables used by the is_a filter")
+    parser.add_argument("ontology", choices=["uberon", "doid", "ncbitaxon"])
+    parser.add_argument("input_path", help="OBO file, or nodes.dmp of the NCBI taxonomy dump")
+    parser.add_argument("--names", default=None, help="names.dmp of the NCBI taxonomy dump")
+    parser.add_argument("--output_path", default=config.PATH_TO_ONTOLOGY_CLOSURES)
+
+    args = parser.parse_args()
+
+    if args.ontology == "ncbitaxon":
+        ids, labels, edges = _read_ncbi_taxonomy(args.input_path, args.names)
+    else:
+        ids, labels, edges = _read_obo(args.input_path, OBO_PREFIXES[args.ontology])
+
+    closure_df = build_ontology_closure(ids, labels, edges)
+
+    os.makedirs(args.output_path, exist_ok=True)
+    closure_df.to_feather(os.path.join(args.output_path, "{}.feather".format(args.ontology)))
+
+    print("Built", args.ontology, "closure of", closure_df["id"].nunique(), "terms in", len(closure_df), "intervals", file=sys.stderr, flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+DURATION_UNITS_MS = {"ms": 1, "s": 1000, "m": 60 * 1000, "h": 60 * 60 * 1000, "d": 24 * 60 * 60 * 1000}
+MEMORY_UNITS_BYTES = {"B": 1, "KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3, "TB": 1024 ** 4, "PB": 1024 ** 5}
+
+# Nextflow trace columns parsed into the history, with how to convert them
+TRACE_DURATION_COLUMNS = {"duration": "duration_ms", "realtime": "realtime_ms"}
+TRACE_MEMORY_COLUMNS = {"peak_rss": "peak_rss_bytes", "peak_vmem": "peak_vmem_bytes", "rchar": "rchar_bytes", "wchar": "wchar_bytes", "read_bytes": "read_bytes", "write_bytes": "write_bytes"}
+
+# History loaded by the web server, reloaded when the file changes
+_run_history_cache = {}
+
+
+def _parse_durations_ms(values):
+    # "1h 2m 3s", "4.5s" or "300ms" to milliseconds, "-" and empty become NaN
+    parts = values.astype(str).str.extractall(r"(?P<value>[\d.]+)(?P<unit>ms|d|h|m|s)")
+    if len(parts) == 0:
+        return pd.Series(np.nan, index=values.index)
+
+    milliseconds = parts["value"].astype(float) * parts["unit"].map(DURATION_UNITS_MS)
+
+    return milliseconds.groupby(level=0).sum().reindex(values.index)
+
+
+def _parse_memory_bytes(values):
+    # "1.2 GB", "345 MB" or "0" to bytes
+    parts = values.astype(str).str.extract(r"^\s*(?P<value>[\d.]+)\s*(?P<unit>[KMGTP]?B)?\s*$")
+
+    return parts["value"].astype(float) * parts["unit"].fillna("B").map(MEMORY_UNITS_BYTES)
+
+
+def _parse_trace(trace_path, run_id):
+    trace_df = pd.read_csv(trace_path, sep="\t", dtype=str)
+
+    history_df = pd.DataFrame(index=trace_df.index)
+    history_df["run_id"] = run_id
+    history_df["task_id"] = pd.to_numeric(trace_df["task_id"], errors="coerce")
+
+    # "NFWORKFLOW:processName (tag)" into the process and its tag
+    name_parts = trace_df["name"].str.extract(r"^(?P<process>[^ ]+)(?: \((?P<tag>.*)\))?$")
+    history_df["process"] = name_parts["process"]
+    history_df["tag"] = name_parts["tag"]
+
+    history_df["status"] = trace_df["status"]
+    history_df["exit"] = pd.to_numeric(trace_df["exit"], errors="coerce") if "exit" in trace_df else np.nan
+    history_df["submit"] = pd.to_datetime(trace_df["submit"], errors="coerce") if "submit" in trace_df else pd.NaT
+
+    for trace_column, history_column in TRACE_DURATION_COLUMNS.items():
+        history_df[history_column] = _parse_durations_ms(trace_df[trace_column]) if trace_column in trace_df else np.nan
+
+    history_df["cpu_percent"] = pd.to_numeric(trace_df["%cpu"].str.rstrip("%"), errors="coerce") if "%cpu" in trace_df else np.nan
+
+    for trace_column, history_column in TRACE_MEMORY_COLUMNS.items():
+        history_df[history_column] = _parse_memory_bytes(trace_df[trace_column]) if trace_column in trace_df else np.nan
+
+    return history_df
+
+
+def _append_run_history(trace_path, history_path, run_id):
+    # Adds one workflow run to the history file, replacing it if that run was already recorded
+    run_df = _parse_trace(trace_path, run_id)
+
+    if os.path.exists(history_path):
+        history_df = pd.read_feather(history_path)
+        history_df = pd.concat([history_df[history_df["run_id"] != run_id], run_df], ignore_index=True)
+    else:
+        history_df = run_df
+
+    # Writing next to the history and renaming, so readers never see a partial file
+    temporary_path = history_path + ".tmp"
+    history_df.reset_index(drop=True).to_feather(temporary_path)
+    os.replace(temporary_path, history_path)
+
+    print("Recorded", len(run_df), "tasks for run", run_id, file=sys.stderr, flush=True)
+
+    return run_df
+
+
+def _load_run_history(history_path):
+    try:
+        last_modified = os.path.getmtime(history_path)
+    except OSError:
+        return None
+
+    cached_modified, history_df = _run_history_cache.get(history_path, (None, None))
+    if cached_modified != last_modified:
+        history_df = pd.read_feather(history_path)
+        _run_history_cache[history_path] = (last_modified, history_df)
+
+    return history_df
+
+
+def _last_run_ids(history_df, runs):
+    return sorted(history_df["run_id"].unique())[-runs:]
+
+
+def _process_summary(history_df):
+    # Per run and process totals of the task level metrics
+    return history_df.groupby(["run_id", "process"]).agg(
+        tasks=("task_id", "count"),
+        failed=("status", lambda status: int((status == "FAILED").sum())),
+        realtime_ms=("realtime_ms", "sum"),
+        max_task_realtime_ms=("realtime_ms", "max"),
+        duration_ms=("duration_ms", "sum"),
+        cpu_percent=("cpu_percent", "mean"),
+        peak_rss_bytes=("peak_rss_bytes", "max"),
+        rchar_bytes=("rchar_bytes", "sum"),
+        wchar_bytes=("wchar_bytes", "sum"),
+    ).reset_index()
+
+
+def _run_summary(history_df):
+    runs_df = history_df.groupby("run_id").agg(
+        tasks=("task_id", "count"),
+        failed=("status", lambda status: int((status == "FAILED").sum())),
+        realtime_ms=("realtime_ms", "sum"),
+        start=("submit", "min"),
+    ).reset_index()
+    runs_df["start"] = runs_df["start"].astype(str)
+
+    return runs_df
+
+
+def _slowest_processes(history_df, run_id=None, top=20):
+    if run_id is None:
+        run_id = _last_run_ids(history_df, 1)[-1]
+
+    summary_df = _process_summary(history_df[history_df["run_id"] == run_id])
+
+    return summary_df.sort_values("realtime_ms", ascending=False).head(top)
+
+
+def _process_trend(history_df, runs=30, process=None):
+    history_df = history_df[history_df["run_id"].isin(_last_run_ids(history_df, runs))]
+    if process is not None:
+        history_df = history_df[history_df["process"] == process]
+
+    return _process_summary(history_df).sort_values(["process", "run_id"])
+
+
+def _process_regressions(history_df, runs=30, threshold=1.5):
+    # Processes of the latest run that are slower than threshold times their median over the previous runs
+    run_ids = _last_run_ids(history_df, runs)
+    summary_df = _process_summary(history_df[history_df["run_id"].isin(run_ids)])
+
+    latest_df = summary_df[summary_df["run_id"] == run_ids[-1]].set_index("process")
+    baseline = summary_df[summary_df["run_id"] != run_ids[-1]].groupby("process")["realtime_ms"].median()
+
+    regressions_df = pd.DataFrame({
+        "process": latest_df.index,
+        "run_id": run_ids[-1],
+        "realtime_ms": latest_df["realtime_ms"].to_numpy(),
+        "baseline_realtime_ms": baseline.reindex(latest_df.index).to_numpy(),
+    })
+    regressions_df["ratio"] = regressions_df["realtime_ms"] / regressions_df["baseline_realtime_ms"]
+
+    regressions_df = regressions_df[regressions_df["ratio"] >= threshold]
+
+    return regressions_df.sort_values("ratio", ascending=False)
@@ -1,4 +1,6 @@
 #!/bin/bash
 
 source activate python310
-celery -A tasks worker -l info -c 1 -Q worker --max-tasks-per-child 10 --loglevel INFO --beat
+
+# Metadata rebuilds, one at a time, this worker also runs the schedule
+celery -A tasks worker -l info -c 1 -Q worker -n rebuild@%h --max-tasks-per-child 10 --loglevel INFO --beat
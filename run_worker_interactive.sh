@@ -0,0 +1,6 @@
+#!/bin/bash
+
+source activate python310
+
+# Light, user facing jobs (MS2 searches, heartbeat) run in their own container next to the rebuilds instead of behind them
+celery -A tasks worker -l info -c 4 -Q interactive -n interactive@%h --max-tasks-per-child 100 --loglevel INFO
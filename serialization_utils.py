@@ -0,0 +1,49 @@
+import orjson
+from flask import Response
+
+# Results larger than this are streamed to the client in chunks of this many rows
+STREAMING_CHUNK_ROWS = 20000
+
+
+def _selected_columns(df, columns=None):
+    if columns is None:
+        return list(df.columns)
+
+    return [column for column in columns if column in df.columns]
+
+
+def _records(df, columns=None):
+    # Record dicts built from one python list per column instead of row by row in pandas
+    columns = _selected_columns(df, columns)
+    column_values = [df[column].tolist() for column in columns]
+
+    return [dict(zip(columns, row_values)) for row_values in zip(*column_values)]
+
+
+def _records_json(df, columns=None):
+    # NaN and inf are encoded as null, so the output is always valid JSON
+    return orjson.dumps(_records(df, columns))
+
+
+def _stream_records_json(df, columns=None, chunk_rows=STREAMING_CHUNK_ROWS):
+    yield b"["
+
+    for chunk_start in range(0, len(df), chunk_rows):
+        if chunk_start > 0:
+            yield b","
+
+        # Stripping the brackets of each chunk so the chunks join into one array
+        yield _records_json(df.iloc[chunk_start:chunk_start + chunk_rows], columns)[1:-1]
+
+    yield b"]"
+
+
+def _json_response(obj):
+    return Response(orjson.dumps(obj), mimetype="application/json")
+
+
+def _records_json_response(df, columns=None, chunk_rows=STREAMING_CHUNK_ROWS):
+    if len(df) <= chunk_rows:
+        return Response(_records_json(df, columns), mimetype="application/json")
+
+    return Response(_stream_records_json(df, columns, chunk_rows=chunk_rows), mimetype="application/json")
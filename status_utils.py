@@ -0,0 +1,139 @@
+import csv
+import re
+import os
+
+import pandas as pd
+
+WORKFLOW_FOLDER = "./workflows/PublicDataset_ReDU_Metadata_Workflow"
+NEXTFLOW_LOG = os.path.join(WORKFLOW_FOLDER, ".nextflow.log")
+NEXTFLOW_STDOUT = os.path.join(WORKFLOW_FOLDER, "nextflowstdout.log")
+NEXTFLOW_TRACE = os.path.join(WORKFLOW_FOLDER, "trace.txt")
+
+# Nextflow console lines, plain ("[ab/123456] Submitted process > NAME (1)") and ansi ("process > NAME [ 50%] 1 of 2")
+NEXTFLOW_TASK_LINE = re.compile(r"\] (?P<event>Submitted|Cached) process > (?P<process>[^ ]+)")
+NEXTFLOW_PROGRESS_LINE = re.compile(r"process > (?P<process>[^ ]+).*\[\s*(?P<percent>\d+)%\]\s+(?P<done>\d+) of (?P<total>\d+)")
+
+# Caps how much new output a single incremental poll returns
+MAX_POLL_BYTES = 1024 * 1024
+
+# Cached between polls, keyed by path and only recomputed when the file changes
+_last_modified_cache = {}
+_trace_progress_cache = {}
+
+
+def _file_last_modified(path, file_stat):
+    cached_mtime, last_modified = _last_modified_cache.get(path, (None, None))
+
+    if cached_mtime != file_stat.st_mtime:
+        # Making this PST time and human readable
+        last_modified = str(pd.to_datetime(file_stat.st_mtime, unit='s').tz_localize('UTC').tz_convert('US/Pacific'))
+        _last_modified_cache[path] = (file_stat.st_mtime, last_modified)
+
+    return last_modified
+
+
+def _tail_lines(path, number_of_lines, block_size=8192):
+    # Reads blocks backwards from the end until enough lines are found
+    with open(path, 'rb') as file:
+        file.seek(0, os.SEEK_END)
+        end_offset = file.tell()
+
+        position = end_offset
+        data = b""
+        while position > 0 and data.count(b"\n") <= number_of_lines:
+            read_size = min(block_size, position)
+            position -= read_size
+            file.seek(position)
+            data = file.read(read_size) + data
+
+    lines = data.splitlines()[-number_of_lines:] if number_of_lines > 0 else []
+
+    return b"\n".join(lines).decode("utf-8", errors="replace"), end_offset
+
+
+def _read_from_offset(path, offset, max_bytes=MAX_POLL_BYTES):
+    with open(path, 'rb') as file:
+        file.seek(0, os.SEEK_END)
+        end_offset = file.tell()
+
+        # The file was truncated, e.g. by a new run, so the client starts over
+        if offset > end_offset:
+            offset = 0
+
+        file.seek(offset)
+        data = file.read(max_bytes)
+
+    # Only returning complete lines, the rest comes with the next poll
+    if not data.endswith(b"\n"):
+        last_newline = data.rfind(b"\n")
+        if last_newline >= 0:
+            data = data[:last_newline + 1]
+
+    return data.decode("utf-8", errors="replace"), offset + len(data)
+
+
+def _log_status(path, number_of_lines=200, offset=None):
+    try:
+        file_stat = os.stat(path)
+    except OSError:
+        return "No log file found", None, 0
+
+    if offset is None:
+        text, new_offset = _tail_lines(path, number_of_lines)
+    else:
+        text, new_offset = _read_from_offset(path, offset)
+
+    return text, _file_last_modified(path, file_stat), new_offset
+
+
+def _trace_progress(path=NEXTFLOW_TRACE):
+    # Task counts per status and per process of the current workflow run
+    try:
+        file_stat = os.stat(path)
+    except OSError:
+        return None
+
+    cache_key = (file_stat.st_mtime, file_stat.st_size)
+    cached_key, progress = _trace_progress_cache.get(path, (None, None))
+    if cached_key == cache_key:
+        return progress
+
+    status_counts = {}
+    process_counts = {}
+    with open(path, newline='') as trace_file:
+        for row in csv.DictReader(trace_file, delimiter='\t'):
+            status = row.get("status", "UNKNOWN")
+            process = row.get("name", "").split(" (")[0]
+
+            status_counts[status] = status_counts.get(status, 0) + 1
+            process_status_counts = process_counts.setdefault(process, {})
+            process_status_counts[status] = process_status_counts.get(status, 0) + 1
+
+    progress = {
+        "tasks": sum(status_counts.values()),
+        "status": status_counts,
+        "processes": process_counts,
+        "lastupdate": _file_last_modified(path, file_stat)
+    }
+    _trace_progress_cache[path] = (cache_key, progress)
+
+    return progress
+
+
+def _update_nextflow_progress(progress, line):
+    # Folds one line of nextflow output into the per process progress of a run
+    task_match = NEXTFLOW_TASK_LINE.search(line)
+    if task_match:
+        process_progress = progress.setdefault(task_match.group("process"), {})
+        event = task_match.group("event").lower()
+        process_progress[event] = process_progress.get(event, 0) + 1
+        return True
+
+    progress_match = NEXTFLOW_PROGRESS_LINE.search(line)
+    if progress_match:
+        process_progress = progress.setdefault(progress_match.group("process"), {})
+        process_progress["done"] = int(progress_match.group("done"))
+        process_progress["total"] = int(progress_match.group("total"))
+        return True
+
+    return False
@@ -1,9 +1,29 @@
 from celery import Celery
+import subprocess
+import redis
 import glob
+import uuid
 import sys
 import os
+import time
+
+import config
+import utils
+import fasst_utils
+import ms2_search_utils
+import status_utils
+import run_history_utils
 
 celery_instance = Celery('tasks', backend='redis://redu-gnps2-redis', broker='pyamqp://guest@redu-gnps2-rabbitmq//', )
+redis_client = redis.Redis(host='redu-gnps2-redis')
+
+REBUILD_LOCK_KEY = "redu:metadata_rebuild"
+REBUILD_TIME_LIMIT = 84600
+PROGRESS_UPDATE_SECONDS = 5
+
+# Marks an MS2 search as queued or running, one key per search key
+FASST_SEARCH_KEY_PREFIX = "redu:fasst_search:"
+FASST_SEARCH_TIME_LIMIT = 3600
 
 @celery_instance.task(time_limit=60)
 def task_computeheartbeat():
@@ -11,20 +31,156 @@ def task_computeheartbeat():
     return "Up"
 
 
-@celery_instance.task(time_limit=84600)
-def tasks_generate_metadata():
+def _acquire_rebuild_lock(job_id):
+    # Only one metadata rebuild at a time, the lock expires with the task time limit if a worker dies
+    return redis_client.set(REBUILD_LOCK_KEY, job_id, nx=True, ex=REBUILD_TIME_LIMIT + 600)
+
+
+def _release_rebuild_lock(job_id):
+    # Deleting only our own lock, atomically in redis
+    redis_client.eval("if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0", 1, REBUILD_LOCK_KEY, job_id)
+
+
+def _running_rebuild_job():
+    job_id = redis_client.get(REBUILD_LOCK_KEY)
+    return job_id.decode() if job_id is not None else None
+
+
+def queue_metadata_rebuild():
+    # Returns the job id of the rebuild, and whether it was newly queued or already running
+    job_id = str(uuid.uuid4())
+
+    if not _acquire_rebuild_lock(job_id):
+        return _running_rebuild_job(), False
+
+    try:
+        tasks_generate_metadata.apply_async(task_id=job_id)
+    except Exception:
+        _release_rebuild_lock(job_id)
+        raise
+
+    return job_id, True
+
+
+@celery_instance.task(bind=True, time_limit=REBUILD_TIME_LIMIT)
+def tasks_generate_metadata(self):
     print("UP", file=sys.stderr, flush=True)
 
-    cmd = "cd /app/workflows/PublicDataset_ReDU_Metadata_Workflow && export MAMBA_ALWAYS_YES='true' &&  \
-        nextflow run ./nf_workflow.nf \
-        --old_redu ./nf_output/merged_metadata.tsv \
-        -c ./nextflow.config > nextflowstdout.log"
-    
-    os.system(cmd)
-    
+    job_id = self.request.id
+
+    # Runs queued by /update already hold the lock, scheduled runs take it here
+    if _running_rebuild_job() != job_id and not _acquire_rebuild_lock(job_id):
+        print("Rebuild already running", _running_rebuild_job(), file=sys.stderr, flush=True)
+        return "Skipped"
+
+    try:
+        run_id = time.strftime("%Y%m%d-%H%M%S", time.gmtime())
+
+        cmd = ["nextflow", "run", "./nf_workflow.nf",
+               "--old_redu", "./nf_output/merged_metadata.tsv",
+               "-c", "./nextflow.config"]
+
+        # Streaming the nextflow output to the log and the per process progress into the task state
+        progress = {}
+        last_update = 0
+        with open(status_utils.NEXTFLOW_STDOUT, 'w') as stdout_file:
+            process = subprocess.Popen(cmd, cwd=status_utils.WORKFLOW_FOLDER, stdout=subprocess.PIPE, text=True, \
+                                       env=dict(os.environ, MAMBA_ALWAYS_YES='true'))
+
+            for line in process.stdout:
+                stdout_file.write(line)
+                stdout_file.flush()
+
+                if status_utils._update_nextflow_progress(progress, line) and time.time() - last_update > PROGRESS_UPDATE_SECONDS:
+                    self.update_state(state="PROGRESS", meta={"run_id": run_id, "processes": progress, "line": line.strip()})
+                    last_update = time.time()
+
+            return_code = process.wait()
+
+        # Publishing the new metadata as a versioned snapshot, the web server switches to it once validated
+        if return_code == 0:
+            self.update_state(state="PROGRESS", meta={"run_id": run_id, "processes": progress, "line": "Publishing snapshot"})
+            utils._publish_snapshot(config.PATH_TO_ORIGINAL_MAPPING_FILE, config.PATH_TO_SNAPSHOTS)
+        else:
+            print("Workflow failed, keeping the current snapshot", return_code, file=sys.stderr, flush=True)
+
+        # Keeping the parsed trace of every run, since the next run overwrites trace.txt
+        try:
+            run_history_utils._append_run_history(status_utils.NEXTFLOW_TRACE, config.PATH_TO_RUN_HISTORY, run_id)
+        except Exception as e:
+            print("Could not record run history", e, file=sys.stderr, flush=True)
+    finally:
+        _release_rebuild_lock(job_id)
+
     return "Up"
 
 
+def queue_fasst_search(usi, min_cosine, min_matching_peaks, fragment_tolerance, precursor_tolerance):
+    # Queues an MS2 search unless the same search is already queued, running or done, returns its task id
+    search_key = fasst_utils._fasst_search_key(usi, min_cosine, min_matching_peaks, fragment_tolerance, precursor_tolerance)
+    task_id = fasst_utils._fasst_task_id(search_key)
+    queued_key = FASST_SEARCH_KEY_PREFIX + search_key
+
+    task_state = celery_instance.AsyncResult(task_id).state
+    if task_state not in ["PENDING", "FAILURE", "REVOKED"]:
+        return task_id
+
+    # Revoked searches never run, so they never clear their key
+    if task_state == "REVOKED":
+        redis_client.delete(queued_key)
+
+    # PENDING is also a search that is queued but not started, the key expires with the task time limit if a worker dies
+    if not redis_client.set(queued_key, task_id, nx=True, ex=FASST_SEARCH_TIME_LIMIT + 600):
+        return task_id
+
+    try:
+        task_fasst_search.apply_async(args=[usi, min_cosine, min_matching_peaks, fragment_tolerance, precursor_tolerance], task_id=task_id)
+    except Exception:
+        redis_client.delete(queued_key)
+        raise
+
+    return task_id
+
+
+@celery_instance.task(time_limit=FASST_SEARCH_TIME_LIMIT)
+def task_fasst_search(usi, min_cosine, min_matching_peaks, fragment_tolerance, precursor_tolerance):
+    print("FASST", usi, file=sys.stderr, flush=True)
+
+    try:
+        return _fasst_search(usi, min_cosine, min_matching_peaks, fragment_tolerance, precursor_tolerance)
+    finally:
+        # Finished or failed, a failed search can be queued again
+        redis_client.delete(FASST_SEARCH_KEY_PREFIX + fasst_utils._fasst_search_key(usi, min_cosine, min_matching_peaks, fragment_tolerance, precursor_tolerance))
+
+
+def _fasst_search(usi, min_cosine, min_matching_peaks, fragment_tolerance, precursor_tolerance):
+    # Searching the local index when it has been built, otherwise the remote FASST service
+    if os.path.exists(config.PATH_TO_MS2_INDEX):
+        precursor_mz, mz_array, intensity_array = ms2_search_utils._fetch_usi_spectrum(usi)
+
+        file_usis = ms2_search_utils.search_ms2_index(config.PATH_TO_MS2_INDEX, precursor_mz, mz_array, intensity_array, \
+                                                      precursor_tolerance=float(precursor_tolerance), \
+                                                      fragment_tolerance=float(fragment_tolerance), \
+                                                      min_cosine=float(min_cosine), \
+                                                      min_matching_peaks=int(min_matching_peaks))
+
+        return {
+            "usis": file_usis,
+            "matched_scans": None
+        }
+
+    results_list = fasst_utils.query_fasst_usi(usi, min_cosine=min_cosine, \
+                                               fragment_tolerance=fragment_tolerance, \
+                                               precursor_tolerance=precursor_tolerance)
+
+    file_usis = fasst_utils._fasst_matched_file_usis(results_list, min_matching_peaks)
+
+    return {
+        "usis": file_usis,
+        "matched_scans": len(results_list)
+    }
+
+
 # TODO: Make this update run every day
 celery_instance.conf.beat_schedule = {
     "cleanup": {
@@ -34,7 +190,13 @@ celery_instance.conf.beat_schedule = {
 }
 
 
+# Heavy rebuilds and light user facing jobs have their own queues and workers, see run_worker.sh
 celery_instance.conf.task_routes = {
-    'tasks.task_computeheartbeat': {'queue': 'worker'},
+    'tasks.task_computeheartbeat': {'queue': 'interactive'},
     'tasks.tasks_generate_metadata': {'queue': 'worker'},
-}
\ No newline at end of file
+    'tasks.task_fasst_search': {'queue': 'interactive'},
+}
+
+# Workers only take the task they are running, so a long rebuild does not hold back queued jobs
+celery_instance.conf.worker_prefetch_multiplier = 1
+celery_instance.conf.task_track_started = True
\ No newline at end of file
@@ -0,0 +1,243 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from pandas.api.extensions import ExtensionArray, ExtensionDtype, register_extension_dtype, take
+from pandas.api.indexers import check_array_indexer
+
+# Datasets whose files carry an "f." prefix that is not part of the USI
+UNPREFIXED_REPOSITORIES = ("ST", "MTBLS")
+
+USI_PATTERN = r"^mzspec:(?P<dataset>[^:]+):(?P<path>[^:].*)$"
+
+# Issues of the published USI column, written next to the snapshot
+USI_ISSUES = "usi_issues.feather"
+
+
+def _split_usis(usis):
+    # mzspec:<dataset>:<path> into a dataset dictionary with one code per row (-1 if malformed) and the path suffix
+    if isinstance(getattr(usis, "array", usis), CompactUsiArray):
+        compact_usis = getattr(usis, "array", usis)
+        return compact_usis._dataset_codes, compact_usis._datasets, compact_usis._paths
+
+    usi_array = pa.array(usis, type=pa.string(), from_pandas=True)
+    if isinstance(usi_array, pa.ChunkedArray):
+        usi_array = usi_array.combine_chunks()
+
+    usi_parts = pc.extract_regex(usi_array, USI_PATTERN)
+
+    encoded_datasets = pc.dictionary_encode(pc.struct_field(usi_parts, "dataset"))
+    dataset_codes = pc.fill_null(encoded_datasets.indices, -1).to_numpy()
+    datasets = encoded_datasets.dictionary.to_numpy(zero_copy_only=False)
+
+    return dataset_codes, datasets, pc.struct_field(usi_parts, "path")
+
+
+def _derive_usis(accessions, filenames):
+    # Same rules as the per row construction it replaces, for all rows at once
+    accessions = accessions.astype(str)
+    paths = filenames.astype(str)
+
+    # Removing "f." from the start for MetaboLights and Metabolomics Workbench
+    unprefixed = accessions.str.startswith(UNPREFIXED_REPOSITORIES) & paths.str.startswith("f.")
+    paths = paths.where(~unprefixed, paths.str.slice(2))
+
+    # Partitioning an empty column has no parts to index
+    if len(paths) == 0:
+        return "mzspec:" + accessions + ":" + paths
+
+    # Removing the "f.<accession>/" folder of the file
+    path_parts = paths.str.partition("/")
+    in_dataset_folder = (path_parts[0] == "f." + accessions) & (path_parts[1] == "/")
+    paths = paths.where(~in_dataset_folder, path_parts[2])
+
+    return "mzspec:" + accessions + ":" + paths
+
+
+def _normalize_usis(redu_df):
+    # Derives every USI, checks the precomputed ones against it and flags the rows that do not agree
+    derived_usis = _derive_usis(redu_df["ATTRIBUTE_DatasetAccession"], redu_df["filename"])
+
+    if "USI" in redu_df.columns:
+        usis = redu_df["USI"]
+    else:
+        usis = pd.Series(np.nan, index=redu_df.index, dtype=object)
+
+    dataset_codes, datasets, _ = _split_usis(usis)
+    malformed = dataset_codes < 0
+
+    # The dataset of a USI has to be the accession of its row
+    usi_datasets = np.append(datasets, "")[dataset_codes]
+    wrong_dataset = ~malformed & (usi_datasets != redu_df["ATTRIBUTE_DatasetAccession"].astype(str).to_numpy())
+
+    # Missing, malformed and misplaced USIs are replaced by the derived ones
+    published_usis = usis.where(~(malformed | wrong_dataset), derived_usis)
+    mismatched = ~malformed & ~wrong_dataset & (usis != derived_usis).to_numpy()
+    duplicated = published_usis.duplicated(keep=False).to_numpy()
+
+    issues = pd.DataFrame({
+        "malformed": malformed,
+        "wrong_dataset": wrong_dataset,
+        "mismatched": mismatched,
+        "duplicated": duplicated,
+    })
+    flagged = issues.any(axis=1).to_numpy()
+
+    issues_df = pd.DataFrame({
+        "row": np.flatnonzero(flagged),
+        "filename": redu_df["filename"][flagged].to_numpy(),
+        "USI": usis[flagged].to_numpy(),
+        "published_USI": published_usis[flagged].to_numpy(),
+        "derived_USI": derived_usis[flagged].to_numpy(),
+    })
+    issues_df = pd.concat([issues_df, issues[flagged].reset_index(drop=True)], axis=1)
+
+    summary = {column: int(issues[column].sum()) for column in issues.columns}
+
+    redu_df = redu_df.assign(USI=published_usis)
+
+    return redu_df, issues_df, summary
+
+
+@register_extension_dtype
+class CompactUsiDtype(ExtensionDtype):
+    # USIs held as a dataset dictionary and a path suffix per row
+    name = "compact_usi"
+    type = str
+    kind = "O"
+    na_value = np.nan
+
+    @classmethod
+    def construct_array_type(cls):
+        return CompactUsiArray
+
+
+class CompactUsiArray(ExtensionArray):
+    # Read only column of USIs, every USI is rebuilt from its parts when it is read.
+    # Malformed USIs have no dataset (code -1) and keep the whole string as their path.
+    def __init__(self, dataset_codes, datasets, paths):
+        self._dataset_codes = dataset_codes
+        self._datasets = datasets
+        self._paths = paths
+
+    @classmethod
+    def _from_sequence(cls, scalars, *, dtype=None, copy=False):
+        usi_array = pa.array(scalars, type=pa.string(), from_pandas=True)
+        if isinstance(usi_array, pa.ChunkedArray):
+            usi_array = usi_array.combine_chunks()
+
+        dataset_codes, datasets, paths = _split_usis(usi_array)
+        code_dtype = np.int16 if len(datasets) < np.iinfo(np.int16).max else np.int32
+
+        return cls(dataset_codes.astype(code_dtype), datasets, pc.coalesce(paths, usi_array))
+
+    @classmethod
+    def _from_factorized(cls, values, original):
+        return cls._from_sequence(values)
+
+    @property
+    def dtype(self):
+        return CompactUsiDtype()
+
+    @property
+    def nbytes(self):
+        return self._dataset_codes.nbytes + self._paths.nbytes + sum(len(dataset) for dataset in self._datasets)
+
+    def __len__(self):
+        return len(self._dataset_codes)
+
+    def _usi_strings(self):
+        # Full USIs as one Arrow array
+        dataset_codes = pa.array(self._dataset_codes, mask=self._dataset_codes < 0, type=pa.int32())
+        datasets = pa.array(self._datasets, type=pa.string()).take(dataset_codes)
+        usis = pc.binary_join_element_wise("mzspec:", datasets, ":", self._paths, "")
+
+        return pc.if_else(pc.is_null(datasets), self._paths, usis)
+
+    def _usi_objects(self):
+        usis = self._usi_strings().to_numpy(zero_copy_only=False)
+        usis[pd.isna(usis)] = np.nan
+
+        return usis
+
+    def __arrow_array__(self, type=None):
+        return self._usi_strings()
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self._usi_objects(), dtype=dtype)
+
+    def __iter__(self):
+        return iter(self._usi_objects())
+
+    def tolist(self):
+        return list(self._usi_objects())
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            return self._usi_objects_at(np.array([item]))[0]
+
+        item = check_array_indexer(self, item)
+        positions = np.arange(len(self))[item]
+        if np.ndim(positions) == 0:
+            return self._usi_objects_at(np.array([positions]))[0]
+
+        return CompactUsiArray(self._dataset_codes[positions], self._datasets, self._paths.take(pa.array(positions, type=pa.int64())))
+
+    def _usi_objects_at(self, positions):
+        return CompactUsiArray(self._dataset_codes[positions], self._datasets, self._paths.take(pa.array(positions, type=pa.int64())))._usi_objects()
+
+    def take(self, indices, allow_fill=False, fill_value=None):
+        positions = take(np.arange(len(self)), indices, allow_fill=allow_fill, fill_value=-1)
+        missing = positions < 0
+
+        dataset_codes = np.where(missing, -1, self._dataset_codes[np.maximum(positions, 0)]) if len(self) > 0 else np.full(len(positions), -1)
+        paths = self._paths.take(pa.array(positions, mask=missing, type=pa.int64()))
+
+        return CompactUsiArray(dataset_codes.astype(self._dataset_codes.dtype), self._datasets, paths)
+
+    def copy(self):
+        # The parts are never modified in place
+        return CompactUsiArray(self._dataset_codes, self._datasets, self._paths)
+
+    @classmethod
+    def _concat_same_type(cls, to_concat):
+        return cls._from_sequence(pa.concat_arrays([compact_usis._usi_strings() for compact_usis in to_concat]))
+
+    def isna(self):
+        return self._paths.is_null().to_numpy(zero_copy_only=False)
+
+    def astype(self, dtype, copy=True):
+        dtype = pd.api.types.pandas_dtype(dtype)
+        if isinstance(dtype, CompactUsiDtype):
+            return self.copy() if copy else self
+
+        return pd.array(self._usi_objects(), dtype=dtype)
+
+    def _values_for_factorize(self):
+        return self._usi_objects(), np.nan
+
+    def _values_for_argsort(self):
+        return self._usi_objects()
+
+    def __eq__(self, other):
+        if isinstance(other, (pd.Series, pd.Index, pd.DataFrame)):
+            return NotImplemented
+
+        if not isinstance(other, str):
+            return np.asarray(self._usi_objects() == np.asarray(other, dtype=object), dtype=bool)
+
+        # Comparing codes and paths instead of rebuilding every USI
+        dataset_codes, datasets, paths = _split_usis([other])
+        if dataset_codes[0] < 0:
+            return np.asarray(pc.fill_null(pc.equal(self._paths, other), False)) & (self._dataset_codes < 0)
+
+        dataset_positions = np.flatnonzero(self._datasets == datasets[0])
+        if len(dataset_positions) == 0:
+            return np.zeros(len(self), dtype=bool)
+
+        return (self._dataset_codes == dataset_positions[0]) & np.asarray(pc.fill_null(pc.equal(self._paths, paths[0].as_py()), False))
+
+
+def _compact_usis(usis):
+    # Same values as the USI column in about half the memory
+    return pd.Series(CompactUsiArray._from_sequence(usis.array), index=usis.index, name=usis.name)
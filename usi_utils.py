@@ -0,0 +1,112 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+from utils import _snapshot_cached, _register_snapshot_preload
+from usi_build_utils import _split_usis
+
+# USI indices, keyed by snapshot version
+_usi_index_cache = {}
+
+
+def _scan_usi_to_file_usi(usi):
+    # mzspec:MSV000084314:path/file.mzML:scan:123 -> mzspec:MSV000084314:path/file.mzML
+    return re.sub(r":(scan|index|nativeId):.*$", "", usi)
+
+
+def _string_hashes(values):
+    # Hashed through the same string dtype as the indexed columns
+    return pd.util.hash_pandas_object(pd.Series(values, dtype=object).astype(str), index=False).to_numpy()
+
+
+def _sorted_hashes(values):
+    # 64 bit hashes in sorted order with the row positions they come from, no strings are kept
+    hashes = _string_hashes(values)
+    order = np.argsort(hashes, kind="stable")
+
+    return hashes[order], order
+
+
+def _build_usi_index(redu_df):
+    sorted_usi_hashes, usi_positions = _sorted_hashes(redu_df["USI"])
+    sorted_filename_hashes, filename_positions = _sorted_hashes(redu_df["filename"])
+
+    # Rows grouped by the dataset of their USI, each dataset a contiguous range
+    dataset_codes, datasets, _ = _split_usis(redu_df["USI"])
+    dataset_positions = np.argsort(dataset_codes, kind="stable")
+    dataset_bounds = np.searchsorted(dataset_codes[dataset_positions], np.arange(len(datasets) + 1), side="left")
+
+    usi_index = {
+        "row_ids": redu_df.index.to_numpy(),
+        "usis": redu_df["USI"],
+        "filenames": redu_df["filename"],
+        "sorted_usi_hashes": sorted_usi_hashes,
+        "usi_positions": usi_positions,
+        "sorted_filename_hashes": sorted_filename_hashes,
+        "filename_positions": filename_positions,
+        "dataset_positions": dataset_positions,
+        "datasets": {dataset: (dataset_bounds[code], dataset_bounds[code + 1]) for code, dataset in enumerate(datasets)},
+    }
+
+    return usi_index
+
+
+def _get_usi_index(redu_df, snapshot_version):
+    return _snapshot_cached(_usi_index_cache, snapshot_version, lambda: _build_usi_index(redu_df))
+
+
+def _expand_ranges(starts, ends, sorted_positions):
+    # Turns per query [start, end) ranges of a sorted lookup into (query position, row position) pairs
+    lengths = ends - starts
+    positions = np.repeat(np.arange(len(starts)), lengths)
+    offsets = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths) if len(lengths) > 0 else lengths
+
+    return positions, sorted_positions[offsets + np.arange(len(positions))]
+
+
+def _hash_matches(sorted_hashes, sorted_positions, values, queries):
+    # Candidates by hash, then compared as strings so a hash collision never matches
+    query_hashes = _string_hashes(queries)
+    starts = np.searchsorted(sorted_hashes, query_hashes, side="left").astype(np.int64)
+    ends = np.searchsorted(sorted_hashes, query_hashes, side="right").astype(np.int64)
+
+    query_positions, row_positions = _expand_ranges(starts, ends, sorted_positions)
+    matching = values.take(row_positions).astype(str).to_numpy() == queries[query_positions]
+
+    return query_positions[matching], row_positions[matching]
+
+
+def _usi_lookup(usi_index, queries):
+    # Each query is a USI (file or scan level), a dataset accession or a ReDU filename
+    queries = np.array([str(query).strip() for query in queries], dtype=object)
+    file_usis = np.array([_scan_usi_to_file_usi(query) for query in queries], dtype=object)
+
+    usi_query_positions, usi_row_positions = _hash_matches(usi_index["sorted_usi_hashes"], usi_index["usi_positions"], usi_index["usis"], file_usis)
+    found = np.zeros(len(queries), dtype=bool)
+    found[usi_query_positions] = True
+
+    # Dataset accessions resolve to all rows of their dataset
+    dataset_starts = np.zeros(len(queries), dtype=np.int64)
+    dataset_ends = np.zeros(len(queries), dtype=np.int64)
+    for position in np.flatnonzero(~found):
+        if queries[position] in usi_index["datasets"]:
+            dataset_starts[position], dataset_ends[position] = usi_index["datasets"][queries[position]]
+    dataset_query_positions, dataset_row_positions = _expand_ranges(dataset_starts, dataset_ends, usi_index["dataset_positions"])
+    found[dataset_query_positions] = True
+
+    # Anything else is tried as a filename
+    remaining = np.flatnonzero(~found)
+    filename_query_positions, filename_row_positions = _hash_matches(usi_index["sorted_filename_hashes"], usi_index["filename_positions"], usi_index["filenames"], queries[remaining])
+    filename_query_positions = remaining[filename_query_positions]
+    found[filename_query_positions] = True
+
+    query_positions = np.concatenate([usi_query_positions, dataset_query_positions, filename_query_positions])
+    row_positions = np.concatenate([usi_row_positions, dataset_row_positions, filename_row_positions])
+
+    order = np.argsort(query_positions, kind="stable")
+
+    return queries[query_positions[order]], usi_index["row_ids"][row_positions[order]], list(queries[~found])
+
+
+_register_snapshot_preload(_get_usi_index)
@@ -1,10 +1,295 @@
 import pandas as pd
-import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+import pyarrow.compute as pc
+import threading
+import argparse
+import hashlib
+import shutil
+import changelog_utils
+import usi_build_utils
 import config
+import json
+import time
+import gzip
+import sys
 import os
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-def _load_redu_sampledata():
+SNAPSHOT_TSV = "merged_metadata.tsv"
+SNAPSHOT_FEATHER = "merged_metadata.feather"
+SNAPSHOT_PARQUET = "merged_metadata.parquet"
+SNAPSHOT_MANIFEST = "manifest.json"
+SNAPSHOT_POINTER = "CURRENT"
+
+# Precompressed variants of the snapshot TSV, by content encoding, written once at publishing
+SNAPSHOT_COMPRESSED_SUFFIXES = {"zstd": ".zst", "gzip": ".gz"}
+
+# Row groups of the Parquet copy queried by DuckDB, small enough that filters can skip most of them
+PARQUET_ROW_GROUP_ROWS = 128 * 1024
+
+# Published snapshots kept on disk, the current one and older ones for rollback
+SNAPSHOTS_TO_KEEP = 3
+
+# TSV ingestion, parsed in blocks of this size on all cores
+TSV_BLOCK_SIZE = 64 * 1024 * 1024
+TSV_NUMERIC_COLUMNS = {"MS2spectra_count": pa.float64()}
+
+# Same missing value markers as pandas.read_csv
+TSV_NULL_VALUES = ["", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+                   "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"]
+
+# How often the web server checks for a newly published snapshot
+SNAPSHOT_POLL_SECONDS = 60
+
+# Snapshot served by the web server and the one before it, swapped as a whole so readers never see a mix
+_active_snapshot = None
+_previous_snapshot = None
+_snapshot_lock = threading.Lock()
+_snapshot_watcher = None
+
+# Called with each newly loaded snapshot before it goes live, so derived indices are warm at cutover
+_snapshot_preload_hooks = []
+
+
+def _read_redu_tsv(path_to_tsv):
+    # Explicit schema from the header, every column is text except the numeric ones
+    with open(path_to_tsv) as tsv_file:
+        header = tsv_file.readline().rstrip("\r\n").split("\t")
+
+    column_types = {column: TSV_NUMERIC_COLUMNS.get(column, pa.string()) for column in header}
+
+    # Blocks are parsed and converted in parallel on all cores
+    redu_table = pacsv.read_csv(path_to_tsv,
+                                read_options=pacsv.ReadOptions(use_threads=True, block_size=TSV_BLOCK_SIZE),
+                                parse_options=pacsv.ParseOptions(delimiter="\t"),
+                                convert_options=pacsv.ConvertOptions(column_types=column_types,
+                                                                     null_values=TSV_NULL_VALUES,
+                                                                     strings_can_be_null=True))
+
+    # making nan, inf and missing values to -1 in the MS2spectra_count column and casting to int in one pass
+    ms2_counts = redu_table.column('MS2spectra_count')
+    ms2_counts = pc.cast(pc.fill_null(pc.if_else(pc.is_finite(ms2_counts), ms2_counts, -1.0), -1.0), pa.int64())
+    redu_table = redu_table.set_column(redu_table.schema.get_field_index('MS2spectra_count'), 'MS2spectra_count', ms2_counts)
+
+    # Missing years are kept as text like the rest of the column
+    years = pc.fill_null(redu_table.column('YearOfAnalysis'), "nan")
+    redu_table = redu_table.set_column(redu_table.schema.get_field_index('YearOfAnalysis'), 'YearOfAnalysis', years)
+
+    return redu_table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def _write_snapshot_tsv(source_tsv, tsv_path, usis):
+    # Copy of the source TSV with its USI column replaced, or added at the end, every other field is kept as is
+    with open(source_tsv, newline="") as source_file, open(tsv_path, 'w', newline="") as tsv_file:
+        header_line = source_file.readline()
+        header = header_line.rstrip("\r\n").split("\t")
+        line_ending = header_line[len(header_line.rstrip("\r\n")):] or "\n"
+
+        usi_position = header.index("USI") if "USI" in header else None
+        if usi_position is None:
+            header.append("USI")
+        tsv_file.write("\t".join(header) + line_ending)
+
+        usi_values = iter(usis.tolist())
+        for line in source_file:
+            fields = line.rstrip("\r\n").split("\t")
+            if len(fields) == 1 and fields[0] == "":
+                continue
+            if usi_position is None:
+                fields.append(next(usi_values))
+            else:
+                fields[usi_position] = next(usi_values)
+            tsv_file.write("\t".join(fields) + line_ending)
+
+
+def _compress_file(path, encoding):
+    compressed_path = path + SNAPSHOT_COMPRESSED_SUFFIXES[encoding]
+
+    with open(path, 'rb') as input_file, open(compressed_path, 'wb') as output_file:
+        if encoding == "zstd":
+            zstandard.ZstdCompressor(level=10, threads=-1).copy_stream(input_file, output_file)
+        else:
+            with gzip.GzipFile(fileobj=output_file, mode='wb', compresslevel=6, mtime=0) as gzip_file:
+                shutil.copyfileobj(input_file, gzip_file, 1024 * 1024)
+
+    return compressed_path
+
+
+def _file_sha256(path, block_size=1024 * 1024):
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            file_hash.update(block)
+
+    return file_hash.hexdigest()
+
+
+##############################
+# Publishing, run by the worker
+##############################
+def _snapshot_pointer_version(snapshots_path):
+    try:
+        with open(os.path.join(snapshots_path, SNAPSHOT_POINTER)) as pointer_file:
+            return pointer_file.read().strip()
+    except OSError:
+        return None
+
+
+def _set_snapshot_pointer(snapshots_path, version):
+    # Replacing the pointer file is atomic, readers see either the old or the new version
+    temporary_pointer = os.path.join(snapshots_path, SNAPSHOT_POINTER + ".tmp")
+    with open(temporary_pointer, 'w') as pointer_file:
+        pointer_file.write(version)
+        pointer_file.flush()
+        os.fsync(pointer_file.fileno())
+
+    os.replace(temporary_pointer, os.path.join(snapshots_path, SNAPSHOT_POINTER))
+
+
+def _list_snapshot_versions(snapshots_path):
+    if not os.path.exists(snapshots_path):
+        return []
+
+    return sorted(version for version in os.listdir(snapshots_path) \
+                  if not version.startswith(".") and os.path.exists(os.path.join(snapshots_path, version, SNAPSHOT_MANIFEST)))
+
+
+def _publish_snapshot(source_tsv, snapshots_path):
+    version = time.strftime("%Y%m%d-%H%M%S", time.gmtime())
+
+    # Building in a hidden folder, only complete snapshots get their final name
+    building_path = os.path.join(snapshots_path, "." + version)
+    version_path = os.path.join(snapshots_path, version)
+    os.makedirs(building_path, exist_ok=True)
+
+    df_redu = _read_redu_tsv(source_tsv)
+
+    # Every USI is derived and checked here, the rows that do not agree are kept in a report next to the snapshot
+    df_redu, usi_issues_df, usi_issues = usi_build_utils._normalize_usis(df_redu)
+    usi_issues_df.to_feather(os.path.join(building_path, usi_build_utils.USI_ISSUES))
+
+    # The TSV is published for /dump with the same USIs as the frame, the feather is what the web server loads
+    _write_snapshot_tsv(source_tsv, os.path.join(building_path, SNAPSHOT_TSV), df_redu["USI"])
+
+    df_redu.to_feather(os.path.join(building_path, SNAPSHOT_FEATHER))
+
+    # Same rows in the same order for the DuckDB query backend, row numbers in the file are the row ids of the frame
+    pq.write_table(pa.Table.from_pandas(df_redu, preserve_index=False), os.path.join(building_path, SNAPSHOT_PARQUET),
+                   row_group_size=PARQUET_ROW_GROUP_ROWS, compression="zstd")
+
+    # Compressed once here so downloads never compress on the fly, zstd only where the library is installed
+    snapshot_files = [SNAPSHOT_TSV, SNAPSHOT_FEATHER, SNAPSHOT_PARQUET, usi_build_utils.USI_ISSUES]
+    for encoding in SNAPSHOT_COMPRESSED_SUFFIXES:
+        if encoding == "zstd" and zstandard is None:
+            continue
+        snapshot_files.append(os.path.basename(_compress_file(os.path.join(building_path, SNAPSHOT_TSV), encoding)))
+
+    # Changelog against the snapshot this one replaces
+    previous_version = _snapshot_pointer_version(snapshots_path)
+    changes = None
+    if previous_version is not None and os.path.exists(os.path.join(snapshots_path, previous_version, SNAPSHOT_FEATHER)):
+        previous_df = pd.read_feather(os.path.join(snapshots_path, previous_version, SNAPSHOT_FEATHER))
+        changes_df, changes = changelog_utils._snapshot_diff(previous_df, df_redu)
+        changelog_utils._write_changelog(snapshots_path, version, previous_version, changes_df)
+        del previous_df
+
+    manifest = {
+        "version": version,
+        "previous_version": previous_version,
+        "changes": changes,
+        "usi_issues": usi_issues,
+        "build_time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "row_count": len(df_redu),
+        "schema": [{"name": column, "dtype": str(dtype)} for column, dtype in df_redu.dtypes.items()],
+        "files": {
+            filename: {
+                "sha256": _file_sha256(os.path.join(building_path, filename)),
+                "size": os.path.getsize(os.path.join(building_path, filename))
+            } for filename in snapshot_files
+        }
+    }
+
+    with open(os.path.join(building_path, SNAPSHOT_MANIFEST), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+    os.rename(building_path, version_path)
+    _set_snapshot_pointer(snapshots_path, version)
+
+    print("Published snapshot", version, "with", len(df_redu), "rows", file=sys.stderr, flush=True)
+
+    _prune_snapshots(snapshots_path, [version, previous_version])
+
+    return manifest
+
+
+def _prune_snapshots(snapshots_path, kept_versions):
+    # Removing old snapshots, the newest ones stay available for rollback.
+    # The kept versions are the one CURRENT points to and the one before it, which web servers may still be serving.
+    for old_version in _list_snapshot_versions(snapshots_path)[:-SNAPSHOTS_TO_KEEP]:
+        if old_version in kept_versions:
+            continue
+        for filename in os.listdir(os.path.join(snapshots_path, old_version)):
+            os.remove(os.path.join(snapshots_path, old_version, filename))
+        os.rmdir(os.path.join(snapshots_path, old_version))
+
+
+def rollback_snapshot(snapshots_path):
+    # Pointing CURRENT at the newest snapshot older than the current one, every web server picks it up with its watcher
+    current_version = _snapshot_pointer_version(snapshots_path)
+    older_versions = [version for version in _list_snapshot_versions(snapshots_path) if current_version is None or version < current_version]
+    if len(older_versions) == 0:
+        return None
+
+    _set_snapshot_pointer(snapshots_path, older_versions[-1])
+
+    return older_versions[-1]
+
+
+##############################
+# Loading, run by the web server
+##############################
+def _load_snapshot(version):
+    version_path = os.path.join(config.PATH_TO_SNAPSHOTS, version)
+
+    with open(os.path.join(version_path, SNAPSHOT_MANIFEST)) as manifest_file:
+        manifest = json.load(manifest_file)
+
+    # Validating before the snapshot can go live
+    feather_path = os.path.join(version_path, SNAPSHOT_FEATHER)
+    if _file_sha256(feather_path) != manifest["files"][SNAPSHOT_FEATHER]["sha256"]:
+        raise Exception("Checksum mismatch for snapshot {}".format(version))
+
+    df_redu = pd.read_feather(feather_path)
+
+    if len(df_redu) != manifest["row_count"]:
+        raise Exception("Snapshot {} has {} rows, manifest says {}".format(version, len(df_redu), manifest["row_count"]))
+
+    if list(df_redu.columns) != [column["name"] for column in manifest["schema"]]:
+        raise Exception("Snapshot {} columns do not match its manifest".format(version))
+
+    last_modified = pd.to_datetime(manifest["build_time"]).tz_convert('US/Pacific')
+
+    # Largest string column, kept as a dataset dictionary and path suffixes
+    df_redu["USI"] = usi_build_utils._compact_usis(df_redu["USI"])
+
+    return {
+        "version": version,
+        "df": df_redu,
+        "manifest": manifest,
+        "path_to_tsv": os.path.join(version_path, SNAPSHOT_TSV),
+        "path_to_parquet": os.path.join(version_path, SNAPSHOT_PARQUET) if SNAPSHOT_PARQUET in manifest["files"] else None,
+        "last_modified": last_modified
+    }
+
+
+def _load_legacy_snapshot():
+    # Before any snapshot is published, the workflow output TSV is served directly
     path_to_binary_version = "./database/merged_metadata.feather"
 
     # Checking age of files
@@ -23,29 +308,135 @@ def _load_redu_sampledata():
     else:
         print("Binary file does not exist, creating")
         use_feather = False
-    
+
     if use_feather:
         df_redu = pd.read_feather(path_to_binary_version)
     else:
-        df_redu = pd.read_csv(config.PATH_TO_ORIGINAL_MAPPING_FILE, sep='\t')
-        df_redu['YearOfAnalysis'] = df_redu['YearOfAnalysis'].astype(str)
+        df_redu, _, _ = usi_build_utils._normalize_usis(_read_redu_tsv(config.PATH_TO_ORIGINAL_MAPPING_FILE))
+        df_redu.to_feather(path_to_binary_version)
 
-        # making nan or inf to -1 in the MS2spectra_count column
-        df_redu['MS2spectra_count'] = df_redu['MS2spectra_count'].replace([np.inf, -np.inf], -1)
-        # making nan to -1
-        df_redu['MS2spectra_count'] = df_redu['MS2spectra_count'].fillna(-1)
-        # casting to int
-        df_redu['MS2spectra_count'] = df_redu['MS2spectra_count'].astype(int)
+    df_redu["USI"] = usi_build_utils._compact_usis(df_redu["USI"])
 
-        df_redu.to_feather(path_to_binary_version)
+    return {
+        "version": "legacy-{}".format(last_modified),
+        "df": df_redu,
+        "manifest": None,
+        "path_to_tsv": config.PATH_TO_ORIGINAL_MAPPING_FILE,
+        "path_to_parquet": None,
+        "last_modified": pd.to_datetime(last_modified, unit='s').tz_localize('UTC').tz_convert('US/Pacific')
+    }
+
+
+def _published_version():
+    pointer_version = _snapshot_pointer_version(config.PATH_TO_SNAPSHOTS)
+    if pointer_version is not None:
+        return pointer_version
+
+    return "legacy-{}".format(os.path.getmtime(config.PATH_TO_ORIGINAL_MAPPING_FILE))
+
+
+def _activate_snapshot(snapshot):
+    global _active_snapshot, _previous_snapshot
+
+    with _snapshot_lock:
+        if _active_snapshot is not None:
+            _previous_snapshot = _active_snapshot
+        _active_snapshot = snapshot
+
+
+def _refresh_redu_snapshot():
+    # Loads and validates a newly published snapshot in the background, then swaps it in
+    published_version = _published_version()
 
-    return df_redu
+    if _active_snapshot is not None and published_version == _active_snapshot["version"]:
+        return False
+
+    try:
+        if _previous_snapshot is not None and published_version == _previous_snapshot["version"]:
+            # Rolled back, the previous snapshot is still loaded
+            snapshot = _previous_snapshot
+        elif published_version.startswith("legacy-"):
+            snapshot = _load_legacy_snapshot()
+        else:
+            snapshot = _load_snapshot(published_version)
+
+        for preload_hook in _snapshot_preload_hooks:
+            preload_hook(snapshot["df"], snapshot["version"])
+    except Exception as e:
+        print("Could not load snapshot", published_version, e, file=sys.stderr, flush=True)
+        return False
+
+    _activate_snapshot(snapshot)
+    print("Serving snapshot", snapshot["version"], file=sys.stderr, flush=True)
+
+    return True
+
+
+def _watch_redu_snapshots():
+    while True:
+        time.sleep(SNAPSHOT_POLL_SECONDS)
+        _refresh_redu_snapshot()
+
+
+def _redu_snapshot():
+    global _active_snapshot, _snapshot_watcher
+
+    if _active_snapshot is None:
+        with _snapshot_lock:
+            if _active_snapshot is None:
+                published_version = _published_version()
+                if published_version.startswith("legacy-"):
+                    _active_snapshot = _load_legacy_snapshot()
+                else:
+                    _active_snapshot = _load_snapshot(published_version)
+
+            if _snapshot_watcher is None:
+                _snapshot_watcher = threading.Thread(target=_watch_redu_snapshots, daemon=True)
+                _snapshot_watcher.start()
+
+    return _active_snapshot
+
+
+def _register_snapshot_preload(preload_hook):
+    _snapshot_preload_hooks.append(preload_hook)
+
+
+def _load_redu_sampledata():
+    # The returned frame is shared by all requests and must not be modified in place
+    return _redu_snapshot()["df"]
+
+def _redu_snapshot_version():
+    # Identifies the currently loaded metadata so per-snapshot caches can be invalidated
+    return _redu_snapshot()["version"]
 
 def _metadata_last_modified():
-    # Checking when this file was last modified
-    last_modified = os.path.getmtime(config.PATH_TO_ORIGINAL_MAPPING_FILE)
+    return _redu_snapshot()["last_modified"]
+
+
+def _snapshot_cached(cache, version, build):
+    # Per snapshot cache holding the live and the preloaded version at most
+    if version not in cache:
+        for old_version in list(cache)[:-1]:
+            del cache[old_version]
+        cache[version] = build()
+
+    return cache[version]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the published metadata snapshots")
+    parser.add_argument("command", choices=["rollback"])
+    parser.add_argument("--snapshots_path", default=config.PATH_TO_SNAPSHOTS)
+
+    args = parser.parse_args()
+
+    version = rollback_snapshot(args.snapshots_path)
+    if version is None:
+        print("No older snapshot to roll back to", file=sys.stderr, flush=True)
+        sys.exit(1)
+
+    print("Rolled back to snapshot", version, file=sys.stderr, flush=True)
 
-    # Making this PST time and human readable
-    last_modified = pd.to_datetime(last_modified, unit='s').tz_localize('UTC').tz_convert('US/Pacific')
 
-    return last_modified
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,22 @@
 # views.py
-from flask import abort, jsonify, render_template, request, redirect, url_for, send_file, make_response
+from flask import abort, jsonify, render_template, request, redirect, url_for, send_file, make_response, Response
 
 from app import app
-from models import *
 
-import os
 import csv
 import json
 import uuid
 import requests
-import pandas as pd
 
 # Local imports
 import config
 import tasks
 import utils
+import status_utils
+import run_history_utils
+import changelog_utils
+from serialization_utils import _json_response, _records_json_response, _stream_records_json
+from http_cache_utils import _snapshot_conditional, _send_snapshot_file
 
 @app.route('/', methods=['GET'])
 def renderhomepage():
@@ -33,67 +35,176 @@ def testapi():
     return_obj["status"] = "success"
     return json.dumps(return_obj)
 
-@app.route('/status.json', methods=['GET'])
-def status():
-    # Checking when this file was last modified
-    last_modified = os.path.getmtime(config.PATH_TO_ORIGINAL_MAPPING_FILE)
-
-    # Making this PST time and human readable
-    last_modified = str(pd.to_datetime(last_modified, unit='s').tz_localize('UTC').tz_convert('US/Pacific'))
+def _non_negative_int_arg(name, default):
+    value = request.values.get(name, None)
+    if value is None:
+        return default
 
-    # Trying to get the text for the nextflow log file
     try:
-        with open("./workflows/PublicDataset_ReDU_Metadata_Workflow/.nextflow.log", 'r') as file:
-            nextflow_log_data = file.read()
-    except:
-        nextflow_log_data = "No log file found"
+        value = int(value)
+    except ValueError:
+        abort(400, "{} must be an integer".format(name))
 
-    log_modified = os.path.getmtime("./workflows/PublicDataset_ReDU_Metadata_Workflow/.nextflow.log")
-    log_modified = str(pd.to_datetime(log_modified, unit='s').tz_localize('UTC').tz_convert('US/Pacific'))
+    if value < 0:
+        abort(400, "{} must not be negative".format(name))
+
+    return value
+
+def _float_arg(name, default):
+    value = request.values.get(name, None)
+    if value is None:
+        return default
 
-    # Trying to read the stdout
     try:
-        with open("./workflows/PublicDataset_ReDU_Metadata_Workflow/nextflowstdout.log", 'r') as file:
-            nextflow_stdout_data = file.read()
-    except:
-        nextflow_stdout_data = "No log file found"
+        return float(value)
+    except ValueError:
+        abort(400, "{} must be a number".format(name))
 
-    stdout_modified = os.path.getmtime("./workflows/PublicDataset_ReDU_Metadata_Workflow/nextflowstdout.log")
-    stdout_modified = str(pd.to_datetime(stdout_modified, unit='s').tz_localize('UTC').tz_convert('US/Pacific'))
+@app.route('/status.json', methods=['GET'])
+def status():
+    # When the served snapshot was built, in PST
+    last_modified = str(utils._metadata_last_modified())
+
+    # Returning the last lines of the logs, or only the output after the offsets a client already has
+    number_of_lines = _non_negative_int_arg("lines", 200)
+    log_offset = _non_negative_int_arg("log_offset", None)
+    stdout_offset = _non_negative_int_arg("stdout_offset", None)
+
+    nextflow_log_data, log_modified, log_offset = status_utils._log_status(status_utils.NEXTFLOW_LOG, \
+        number_of_lines=number_of_lines, offset=log_offset)
+
+    nextflow_stdout_data, stdout_modified, stdout_offset = status_utils._log_status(status_utils.NEXTFLOW_STDOUT, \
+        number_of_lines=number_of_lines, offset=stdout_offset)
 
     return_obj = {}
     return_obj["lastupdate"] = last_modified
     return_obj["nextflow"] = {
         "log": nextflow_log_data,
         "log_lastupdate" : log_modified,
+        "log_offset" : log_offset,
         "stdout" : nextflow_stdout_data,
-        "stdout_lastupdate" : stdout_modified
+        "stdout_lastupdate" : stdout_modified,
+        "stdout_offset" : stdout_offset,
+        "progress" : status_utils._trace_progress()
     }
 
     return json.dumps(return_obj)
 
 @app.route('/status.trace', methods=['GET'])
 def status_trace():
-    return send_file("./workflows/PublicDataset_ReDU_Metadata_Workflow/trace.txt")
+    return send_file(status_utils.NEXTFLOW_TRACE)
 
 @app.route('/status.timeline', methods=['GET'])
 def status_timeline():
     return send_file("./workflows/PublicDataset_ReDU_Metadata_Workflow/timeline.html")
 
+@app.route('/status/history/runs', methods=['GET'])
+def status_history_runs():
+    history_df = run_history_utils._load_run_history(config.PATH_TO_RUN_HISTORY)
+    if history_df is None:
+        return _json_response([])
+
+    return _records_json_response(run_history_utils._run_summary(history_df))
+
+@app.route('/status/history/slowest', methods=['GET'])
+def status_history_slowest():
+    history_df = run_history_utils._load_run_history(config.PATH_TO_RUN_HISTORY)
+    if history_df is None:
+        return _json_response([])
+
+    slowest_df = run_history_utils._slowest_processes(history_df, \
+                                                      run_id=request.values.get("run_id", None), \
+                                                      top=_non_negative_int_arg("top", 20))
+
+    return _records_json_response(slowest_df)
+
+@app.route('/status/history/trend', methods=['GET'])
+def status_history_trend():
+    history_df = run_history_utils._load_run_history(config.PATH_TO_RUN_HISTORY)
+    if history_df is None:
+        return _json_response([])
+
+    trend_df = run_history_utils._process_trend(history_df, \
+                                                runs=_non_negative_int_arg("runs", 30), \
+                                                process=request.values.get("process", None))
+
+    return _records_json_response(trend_df)
+
+@app.route('/status/history/regressions', methods=['GET'])
+def status_history_regressions():
+    history_df = run_history_utils._load_run_history(config.PATH_TO_RUN_HISTORY)
+    if history_df is None:
+        return _json_response([])
+
+    regressions_df = run_history_utils._process_regressions(history_df, \
+                                                            runs=_non_negative_int_arg("runs", 30), \
+                                                            threshold=_float_arg("threshold", 1.5))
+
+    return _records_json_response(regressions_df)
+
 
 # manually trigger the task
 @app.route('/update', methods=['GET'])
 def update():
-    # run the task
-    tasks.tasks_generate_metadata.apply_async()
-    
-    return "Queued"
+    # run the task, unless a rebuild is already running
+    job_id, queued = tasks.queue_metadata_rebuild()
+
+    return_obj = {}
+    return_obj["job_id"] = job_id
+    return_obj["status"] = "Queued" if queued else "Running"
+
+    return json.dumps(return_obj)
+
+@app.route('/update/<job_id>', methods=['GET'])
+def update_status(job_id):
+    task_result = tasks.celery_instance.AsyncResult(job_id)
+
+    return_obj = {}
+    return_obj["job_id"] = job_id
+    return_obj["state"] = task_result.state
+    return_obj["progress"] = task_result.info if task_result.state == "PROGRESS" else None
+    return_obj["running_job_id"] = tasks._running_rebuild_job()
+
+    return json.dumps(return_obj)
+
+
+@app.route('/snapshot.json', methods=['GET'])
+def snapshot_status():
+    redu_snapshot = utils._redu_snapshot()
+
+    return_obj = {}
+    return_obj["version"] = redu_snapshot["version"]
+    return_obj["manifest"] = redu_snapshot["manifest"]
+    return_obj["previous_version"] = utils._previous_snapshot["version"] if utils._previous_snapshot is not None else None
+    return_obj["published_version"] = utils._published_version()
+
+    return json.dumps(return_obj)
+
+# rows added, removed or changed since an earlier snapshot, keyed on USI
+@app.route('/snapshot/changes', methods=['GET'])
+@_snapshot_conditional
+def snapshot_changes():
+    since_version = request.args.get("since")
+    if since_version is None:
+        abort(400, "since is required")
+
+    current_version = utils._redu_snapshot_version()
+    changes_df = changelog_utils._changes_since(config.PATH_TO_SNAPSHOTS, since_version, current_version)
+
+    if changes_df is None:
+        abort(410, "No changelog from {} to {}, download /dump instead".format(since_version, current_version))
+
+    def _stream_changes():
+        yield b'{"since": ' + json.dumps(since_version).encode() + b', "version": ' + json.dumps(current_version).encode() + b', "changes": '
+        yield from _stream_records_json(changes_df)
+        yield b'}'
+
+    return Response(_stream_changes(), mimetype="application/json")
 
 
 @app.route('/dump', methods=['GET'])
 def dump():
-    return send_file(config.PATH_TO_ORIGINAL_MAPPING_FILE, \
-                     max_age=1, as_attachment=True, \
-                     download_name="all_sampleinformation.tsv")
+    # Revalidated with the snapshot ETag, compressed variants and byte ranges for resuming
+    return _send_snapshot_file(utils._redu_snapshot()["path_to_tsv"], "all_sampleinformation.tsv")
 
 
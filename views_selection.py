@@ -1,10 +1,23 @@
 from app import app
 import json
+import re
+import orjson
 import pandas as pd
-from flask import request
+from flask import abort, request, Response
+import numpy as np
 
-import config
 from ontology_utils import resolve_ontology
+from utils import _redu_snapshot
+from usi_utils import _get_usi_index, _usi_lookup
+from serialization_utils import _records, _records_json, _records_json_response, _json_response, _stream_records_json
+from facet_utils import _redu_facets
+from filter_utils import _get_coded_columns, _filter_masks, _filter_part_mask
+from http_cache_utils import _snapshot_conditional, _snapshot_artifact_response
+from duckdb_utils import _duckdb_query, _duckdb_term_counts
+from views import _non_negative_int_arg
+
+# Largest batch of filter queries answered in one request
+MAX_BATCH_QUERIES = 200
 
 black_list_attribute = ["SubjectIdentifierAsRecorded", "UniqueSubjectID", "UBERONOntologyIndex", "DOIDOntologyIndex", "ComorbidityListDOIDIndex"]
 
@@ -13,8 +26,12 @@ black_list_attribute = ["SubjectIdentifierAsRecorded", "UniqueSubjectID", "UBERO
 ##############################
 @app.route('/attributes', methods=['GET'])
 def viewattributes():
+    return _snapshot_artifact_response(_attributes_json)
+
+
+def _attributes_json():
     # Reading the dump instead of the database
-    metadata_df = pd.read_csv(config.PATH_TO_ORIGINAL_MAPPING_FILE, sep="\t", dtype=str)
+    metadata_df = pd.read_csv(_redu_snapshot()["path_to_tsv"], sep="\t", dtype=str)
 
     all_attributes_list = list(metadata_df.columns)
 
@@ -37,82 +54,171 @@ def viewattributes():
 
     output_list = sorted(output_list, key=lambda x: x["attributedisplay"], reverse=False)
 
-    return json.dumps(output_list)
+    return orjson.dumps(output_list)
 
 
 #Returns all the terms given an attribute along with file counts for each term
 @app.route('/attribute/<attribute>/attributeterms', methods=['GET'])
+@_snapshot_conditional
 def viewattributeterms(attribute):
-    metadata_df = pd.read_csv(config.PATH_TO_ORIGINAL_MAPPING_FILE, sep="\t", dtype=str)
     filters_list = json.loads(request.values.get('filters', "[]"))
 
-    # Applying filters
-    for filterobject in filters_list:
-        filter_attribute = filterobject["attributename"]
-        filter_term = filterobject["attributeterm"]
+    # Unfiltered term counts are the same for everyone until the next snapshot
+    if len(filters_list) == 0:
+        return _snapshot_artifact_response(lambda: _records_json(_attribute_terms_df(attribute, filters_list)))
 
-        #TODO: check for types
-        metadata_df = metadata_df[metadata_df[filter_attribute] == filter_term]
+    return _records_json_response(_attribute_terms_df(attribute, filters_list))
 
-    terms_list = list(set(metadata_df[attribute]))
 
-    output_list = []
-    grouped_term_df = metadata_df.groupby(attribute)
-    for term, term_df in grouped_term_df:
-        #term_df = metadata_df[metadata_df[attribute] == term]
-        if len(term_df) > 0:
-            output_dict = {}
-            output_dict["attributename"] = attribute
-            output_dict["attributeterm"] = term
-            output_dict["ontologyterm"] = resolve_ontology(attribute, term)
-            output_dict["countfiles"] = len(term_df)
-            output_list.append(output_dict)
+def _attribute_terms_df(attribute, filters_list):
+    # Grouped in DuckDB over the snapshot Parquet file when it is available
+    filter_query = " && ".join('{{{}}} = "{}"'.format(filterobject["attributename"], filterobject["attributeterm"]) for filterobject in filters_list)
+    counts_df = _duckdb_query(_redu_snapshot(), _duckdb_term_counts, attribute, filter_query)
 
-    return json.dumps(output_list)
+    if counts_df is not None:
+        term_counts = pd.Series(counts_df["countfiles"].to_numpy(), index=counts_df["term"].to_numpy())
+    else:
+        metadata_df = pd.read_csv(_redu_snapshot()["path_to_tsv"], sep="\t", dtype=str)
 
-#Returns all the terms given an attribute along with file counts for each term
-@app.route('/attribute/<attribute>/attributeterm/<term>/files', methods=['GET'])
-def viewfilesattributeattributeterm(attribute, term):
-    metadata_df = pd.read_csv(config.PATH_TO_ORIGINAL_MAPPING_FILE, sep="\t", dtype=str)
-    
-    metadata_df = metadata_df[metadata_df[attribute] == term]
+        # Applying filters
+        for filterobject in filters_list:
+            filter_attribute = filterobject["attributename"]
+            filter_term = filterobject["attributeterm"]
 
-    return json.dumps(metadata_df.to_dict(orient="records"))    
+            #TODO: check for types
+            metadata_df = metadata_df[metadata_df[filter_attribute] == filter_term]
 
-    ### THIS IS DEPRECATED LOGIC
-    
-    
-    filters_list = json.loads(request.values.get('filters', "[]"))
+        # Counting all terms at once, sorted by term like the groupby it replaces
+        term_counts = metadata_df[attribute].value_counts(sort=False).sort_index()
 
-    # Applying filters
-    for filterobject in filters_list:
-        filter_attribute = filterobject["attributename"]
-        filter_term = filterobject["attributeterm"]
+    terms_df = pd.DataFrame({
+        "attributename": attribute,
+        "attributeterm": term_counts.index,
+        "ontologyterm": [resolve_ontology(attribute, term) for term in term_counts.index],
+        "countfiles": term_counts.to_numpy()
+    })
 
-        #TODO: check for types
-        metadata_df = metadata_df[metadata_df[filter_attribute] == filter_term]
+    return terms_df
 
-    metadata_df = metadata_df[["filename", attribute, "ATTRIBUTE_DatasetAccession"]]
-    metadata_df = metadata_df[metadata_df[attribute] == term]
-
-    metadata_list = metadata_df.to_dict(orient="records")
+#Returns the term counts of all attributes under a filter, for drill down
+@app.route('/facets', methods=['GET'])
+@_snapshot_conditional
+def viewfacets():
+    # DataTable filter query like the selection table, the filters list of attributeterms is also accepted
+    filter_query = request.values.get("filter", "")
+    filters_list = json.loads(request.values.get('filters', "[]"))
+    filter_parts = [filter_query] if filter_query else []
+    filter_parts += ['{{{}}} = "{}"'.format(filterobject["attributename"], filterobject["attributeterm"]) for filterobject in filters_list]
 
-    output_list = []
-    for metadata_obj in metadata_list:
-        output_dict = {}
-        output_dict["attribute"] = attribute
-        output_dict["attributeterm"] = term
-        output_dict["filename"] = metadata_obj["filename"]
-        output_dict["dataset"] = metadata_obj["ATTRIBUTE_DatasetAccession"]
+    attributes_list = request.values.get("attributes", None)
+    attributes_list = attributes_list.split(",") if attributes_list else None
 
-        # Trying to create a USI for the file
-        modified_filename = str(metadata_obj["filename"])
-        if metadata_obj["ATTRIBUTE_DatasetAccession"].startswith(("ST", "MTBLS")) and modified_filename.startswith("f."):
-            modified_filename = modified_filename[2:]  # Remove "f." from the start
+    top = _non_negative_int_arg("top", 20)
 
-        # Create a USI for the file
-        output_dict["usi"] = "mzspec:" + metadata_obj["ATTRIBUTE_DatasetAccession"] + ":" + modified_filename.replace("f.{}/".format(metadata_obj["ATTRIBUTE_DatasetAccession"]), "")
+    facets = _redu_facets(_redu_snapshot(), " && ".join(filter_parts), black_list_attribute + ["filename"], attributes_list, top)
 
-        output_list.append(output_dict)
+    return _json_response(facets)
 
-    return json.dumps(output_list)
\ No newline at end of file
+#Returns all the terms given an attribute along with file counts for each term
+@app.route('/attribute/<attribute>/attributeterm/<term>/files', methods=['GET'])
+@_snapshot_conditional
+def viewfilesattributeattributeterm(attribute, term):
+    redu_snapshot = _redu_snapshot()
+    redu_df = redu_snapshot["df"]
+    if attribute not in redu_df.columns:
+        abort(404)
+
+    # Comparing integer codes of the in memory snapshot, numeric columns are matched on their text like the dump
+    if redu_df[attribute].dtype.kind in "iuf":
+        term_mask = (redu_df[attribute].astype(str) == term).to_numpy()
+    else:
+        term_mask = _filter_part_mask(redu_df, attribute, "=", term, _get_coded_columns(redu_df, redu_snapshot["version"]))
+
+    metadata_df = redu_df[term_mask]
+
+    columns_list = request.values.get("columns", None)
+    columns_list = columns_list.split(",") if columns_list else None
+
+    return _records_json_response(metadata_df, columns_list)
+
+
+#Returns the metadata rows for many USIs, dataset accessions or filenames in one pass
+@app.route('/usis/lookup', methods=['POST'])
+def lookupusis():
+    if request.is_json:
+        request_json = request.get_json()
+        queries_list = request_json.get("usis", [])
+        columns_list = request_json.get("columns", None)
+    else:
+        queries_list = request.values.get("usis", "").split("\n")
+        columns_list = None
+
+    queries_list = [query for query in queries_list if len(str(query).strip()) > 0]
+
+    redu_snapshot = _redu_snapshot()
+    metadata_df = redu_snapshot["df"]
+    usi_index = _get_usi_index(metadata_df, redu_snapshot["version"])
+
+    matched_queries, row_ids, not_found = _usi_lookup(usi_index, queries_list)
+
+    metadata_df = metadata_df.loc[row_ids]
+    if columns_list:
+        metadata_df = metadata_df[[column for column in columns_list if column in metadata_df.columns]]
+    metadata_df.insert(0, "query", matched_queries)
+
+    def _stream_lookup():
+        yield b'{"results": '
+        yield from _stream_records_json(metadata_df)
+        yield b', "not_found": ' + orjson.dumps(not_found) + b'}'
+
+    return Response(_stream_lookup(), mimetype="application/json")
+
+
+#Answers many filter queries in the table's filter grammar in one request, each with a count, sampled rows or USIs
+@app.route('/query/batch', methods=['POST'])
+def batchquery():
+    # {"queries": [{"filter": "{NCBITaxonomy} = \"9606|Homo sapiens\"", "result": "count" | "rows" | "usis", "limit": 100, "columns": [...]}]}
+    queries_list = request.get_json().get("queries", [])
+    queries_list = [{"filter": query} if isinstance(query, str) else query for query in queries_list]
+
+    if len(queries_list) > MAX_BATCH_QUERIES:
+        abort(400, "At most {} queries per request".format(MAX_BATCH_QUERIES))
+
+    # Results are streamed, so every limit is checked before the first one is written
+    for query in queries_list:
+        limit = query.get("limit", None)
+        if limit is not None and (not isinstance(limit, int) or isinstance(limit, bool) or limit < 0):
+            abort(400, "Invalid limit: {}".format(limit))
+
+    redu_snapshot = _redu_snapshot()
+    metadata_df = redu_snapshot["df"]
+    coded_columns = _get_coded_columns(metadata_df, redu_snapshot["version"])
+
+    try:
+        masks = _filter_masks(metadata_df, [query.get("filter", "") for query in queries_list], coded_columns)
+    except (ValueError, re.error) as e:
+        abort(400, "Invalid filter: {}".format(e))
+
+    def _query_result(query, mask):
+        result = {"filter": query.get("filter", ""), "count": int(mask.sum())}
+        result_type = query.get("result", "count")
+        limit = query.get("limit", None)
+
+        row_positions = np.flatnonzero(mask)
+        if result_type == "rows":
+            # Same rows for the same query on the same snapshot
+            sample_size = min(len(row_positions), limit if limit is not None else 100)
+            row_positions = np.sort(np.random.default_rng(0).choice(row_positions, sample_size, replace=False))
+            result["rows"] = _records(metadata_df.iloc[row_positions], query.get("columns", None))
+        elif result_type == "usis":
+            result["usis"] = metadata_df["USI"].take(row_positions[:limit]).tolist()
+
+        return result
+
+    def _stream_batch():
+        yield b'{"version": ' + orjson.dumps(redu_snapshot["version"]) + b', "results": ['
+        for position, (query, mask) in enumerate(zip(queries_list, masks)):
+            yield (b"," if position > 0 else b"") + orjson.dumps(_query_result(query, mask))
+        yield b']}'
+
+    return Response(_stream_batch(), mimetype="application/json")